@@ -0,0 +1,350 @@
+# Бенчмарк проверки цен без обращения к настоящим магазинам.
+#
+# Все запросы check_price перенаправляются на локальный HTTP-сервер (резолвер HTTP-сессии
+# возвращает для любого хоста его адрес), который отдает сохраненные страницы товаров
+# из папки с фикстурами (по одному файлу на магазин):
+#     benchmark_fixtures/onliner.html, benchmark_fixtures/21vek.html, ...
+# Сохранить страницу можно, например, так:
+#     curl -L -o benchmark_fixtures/21vek.html "https://www.21vek.by/..."
+# Ответы пакетных API onliner и wb сервер формирует сам по списку запрошенных товаров.
+#
+# Товары для бенчмарка добавляются в базу из .env (DB_*) и удаляются после прогона,
+# поэтому запускать лучше на локальной копии базы:
+#     DB_NAME=autoparts_bench python benchmark_scrape.py --products-per-market 200 --cycles 3
+#
+# Для контроля регрессий сохраните результат (--output) и сравнивайте с ним (--baseline):
+# если товаров в секунду стало меньше больше чем на --max-regression, скрипт завершится с кодом 1.
+# Товары, проверка которых закончилась ошибкой, в скорость и время проверки не входят;
+# если таких больше --max-error-rate, скрипт тоже завершится с кодом 1.
+import argparse
+import asyncio
+import json
+import logging
+import pathlib
+import random
+import resource
+import socket
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+import script
+from config import (HTTP_CONNECT_TIMEOUT, HTTP_LIMIT_PER_HOST,
+                    HTTP_MAX_IN_FLIGHT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT,
+                    ONLINER_BATCH_API_URL, WB_BATCH_API_URL,)
+from database import close_pool, get_pool, init_db, insert_price_history
+from script import (check_price, close_parse_executor, close_session,
+                    start_parse_executor,)
+
+
+# Адреса товаров для каждого магазина ({n} - номер товара).
+# Локальный сервер без TLS, поэтому адреса http://
+BENCH_PRODUCT_URLS = {
+    "onliner": "http://catalog.onliner.by/autoparts/bench/bench{n}",
+    "wb": "http://www.wildberries.by/catalog/{n}/detail.aspx",
+    "21vek": "http://www.21vek.by/bench/bench{n}.html",
+    "remzona": "http://remzona.by/bench/bench{n}",
+    "shate-mag": "http://shate-mag.by/bench/bench{n}",
+}
+
+# По какой части адреса определяем магазин
+BENCH_HOSTS = {
+    "onliner": "onliner",
+    "wildberries": "wb",
+    "wb.ru": "wb",
+    "21vek": "21vek",
+    "remzona": "remzona",
+    "shate-mag": "shate-mag",
+}
+
+BENCH_TITLE_PREFIX = "bench-"
+
+
+# -----------------------------------------------------------------------------------------------------------------------Локальный сервер магазинов
+def get_market_from_host(host):
+    for part, market in BENCH_HOSTS.items():
+        if part in host:
+            return market
+    return None
+
+
+# Ответ пакетного API Wildberries для запрошенных товаров
+def make_wb_batch(ids):
+    products = [
+        {
+            "id": int(product_id),
+            "name": f"{BENCH_TITLE_PREFIX}wb-{product_id}",
+            "totalQuantity": 10,
+            "sizes": [{"price": {"product": 1000 + int(product_id) % 500}}],
+        }
+        for product_id in ids
+        if product_id.isdigit()
+    ]
+    return {"data": {"products": products}}
+
+
+# Ответ пакетного API onliner для запрошенных товаров
+def make_onliner_batch(keys):
+    products = [
+        {
+            "key": key,
+            "full_name": f"{BENCH_TITLE_PREFIX}onliner-{key}",
+            "prices": {"price_min": {"amount": "12.34", "currency": "BYN"}},
+        }
+        for key in keys
+    ]
+    return {"products": products}
+
+
+def create_app(fixtures, latency_ms, jitter_ms, error_rate, not_modified_rate):
+    async def handle(request):
+        delay = max(0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        if random.random() < error_rate:
+            return web.Response(status=503)
+
+        if request.headers.get("If-None-Match") and random.random() < not_modified_rate:
+            return web.Response(status=304)
+
+        host = request.host.split(":")[0]
+        headers = {"ETag": '"bench"'}
+        if host == "card.wb.ru":
+            ids = request.query.get("nm", "").split(";")
+            return web.json_response(make_wb_batch(ids), headers=headers)
+        if "sdapi" in request.path:
+            return web.json_response(
+                make_onliner_batch(request.query.getall("key[]", [])), headers=headers
+            )
+
+        body = fixtures.get(get_market_from_host(host), "<html><body></body></html>")
+        return web.Response(text=body, content_type="text/html", headers=headers)
+
+    app = web.Application()
+    app.router.add_route("GET", "/{tail:.*}", handle)
+    return app
+
+
+# Загружаем сохраненные страницы товаров
+def load_fixtures(path):
+    fixtures = {}
+    for market in BENCH_PRODUCT_URLS:
+        file = pathlib.Path(path) / f"{market}.html"
+        if file.exists():
+            fixtures[market] = file.read_text(encoding="utf-8", errors="replace")
+        else:
+            logging.warning(f"Нет сохраненной страницы для {market}: {file}")
+    return fixtures
+
+
+# Резолвер, который для любого хоста возвращает адрес локального сервера.
+# Заголовок Host остается прежним - по нему сервер определяет магазин
+class ReplayResolver(AbstractResolver):
+    def __init__(self, port):
+        self.port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [
+            {
+                "hostname": host,
+                "host": "127.0.0.1",
+                "port": self.port,
+                "family": socket.AF_INET,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+        ]
+
+    async def close(self):
+        pass
+
+
+# -----------------------------------------------------------------------------------------------------------------------Тестовые товары в базе
+async def seed_products(products_per_market):
+    pool = await get_pool()
+    products = []
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            for market, url_template in BENCH_PRODUCT_URLS.items():
+                for n in range(products_per_market):
+                    url = url_template.format(n=900000000 + n)
+                    product_id = await conn.fetchval(
+                        "INSERT INTO products (product_url, product_title, product_image_url, status, market) "
+                        "VALUES ($1, $2, $3, $4, $5) RETURNING id",
+                        url,
+                        f"{BENCH_TITLE_PREFIX}{market}-{n}",
+                        None,
+                        0,
+                        market,
+                    )
+                    await insert_price_history(
+                        conn, product_id, script.STATUS_IN_STOCK, int(time.time()), 1000
+                    )
+                    products.append((product_id, url, market))
+    return products
+
+
+async def delete_products(products):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            product_ids = [product[0] for product in products]
+            await conn.execute(
+                "DELETE FROM product_price_history WHERE product_id = ANY($1)", product_ids
+            )
+            await conn.execute(
+                "DELETE FROM product_price_summary WHERE product_id = ANY($1)", product_ids
+            )
+            await conn.execute("DELETE FROM products WHERE id = ANY($1)", product_ids)
+            await conn.execute(
+                "DELETE FROM http_validators WHERE url = ANY($1)",
+                [product[1] for product in products],
+            )
+
+
+# -----------------------------------------------------------------------------------------------------------------------Замеры
+# Задержка цикла событий: насколько позже запланированного просыпается sleep
+async def monitor_loop_lag(samples, interval=0.01):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - start - interval)
+
+
+def percentile(values, n):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100)[n - 1]
+
+
+# Медиана перцентиля времени проверки товара по всем циклам
+def median_latency(reports, key):
+    values = [report["latency"][key] for report in reports if report["latency"][key] is not None]
+    return statistics.median(values) if values else None
+
+
+async def run_benchmark(args):
+    fixtures = load_fixtures(args.fixtures)
+    app = create_app(
+        fixtures, args.latency_ms, args.jitter_ms, args.error_rate, args.not_modified_rate
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    if args.no_rate_limit:
+        script.HOST_RATE_LIMIT_DEFAULT = (1_000_000, 1_000_000)
+
+    # Пакетные API тоже запрашиваем у локального сервера по http
+    script.WB_BATCH_API_URL = WB_BATCH_API_URL.replace("https://", "http://", 1)
+    script.ONLINER_BATCH_API_URL = ONLINER_BATCH_API_URL.replace("https://", "http://", 1)
+
+    script.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=HTTP_MAX_IN_FLIGHT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            resolver=ReplayResolver(port),
+        ),
+        timeout=aiohttp.ClientTimeout(
+            total=HTTP_TOTAL_TIMEOUT,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        ),
+    )
+    await init_db()
+    await start_parse_executor()
+    products = await seed_products(args.products_per_market)
+
+    lag_samples = []
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+    reports = []
+    try:
+        for _ in range(args.cycles):
+            reports.append(await check_price(products))
+    finally:
+        monitor.cancel()
+        await delete_products(products)
+        await close_session()
+        await close_parse_executor()
+        await close_pool()
+        await runner.cleanup()
+
+    wall_time = sum(report["wall_time"] for report in reports)
+    checked = sum(report["products"] for report in reports)
+    errors = sum(report["errors"] for report in reports)
+    market_errors = {}
+    for report in reports:
+        for market, item in report["markets"].items():
+            market_errors[market] = market_errors.get(market, 0) + item["errors"]
+    result = {
+        "products": len(products),
+        "cycles": args.cycles,
+        # Только успешно проверенные товары
+        "products_per_sec": round(checked / wall_time, 2) if wall_time else 0,
+        "errors": errors,
+        "error_rate": round(errors / (checked + errors), 4) if checked + errors else 0,
+        "market_errors": market_errors,
+        "latency": {key: median_latency(reports, key) for key in ("p50", "p95", "p99")},
+        "loop_lag": {
+            "p50": round(percentile(lag_samples, 50) or 0, 4),
+            "p99": round(percentile(lag_samples, 99) or 0, 4),
+            "max": round(max(lag_samples, default=0), 4),
+        },
+        # На Linux ru_maxrss в килобайтах
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "http_cache": reports[-1]["http_cache"] if reports else {},
+        "hosts": reports[-1]["hosts"] if reports else {},
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк проверки цен на сохраненных страницах")
+    parser.add_argument("--fixtures", default="benchmark_fixtures")
+    parser.add_argument("--products-per-market", type=int, default=100)
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-modified-rate", type=float, default=0.0)
+    parser.add_argument("--no-rate-limit", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = asyncio.run(run_benchmark(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(result, indent=2), encoding="utf-8")
+
+    if result["error_rate"] > args.max_error_rate:
+        print(
+            f"Ошибки проверки: {result['errors']} ({result['error_rate']:.2%}), "
+            f"допустимо не больше {args.max_error_rate:.2%}, по магазинам {result['market_errors']}"
+        )
+        sys.exit(1)
+
+    if args.baseline:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text(encoding="utf-8"))
+        limit = baseline["products_per_sec"] * (1 - args.max_regression)
+        if result["products_per_sec"] < limit:
+            print(
+                f"Регрессия: {result['products_per_sec']} товаров/сек, "
+                f"ожидалось не меньше {round(limit, 2)}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,137 @@
-# Через какой интервал (в секундах) надо проверять страницу с URL и рассылать уведомления пользователям
-CHECKINTERVAL = 10
+# Настройки HTTP-клиента для запросов к магазинам
+# Таймаут на установку соединения (в секундах)
+HTTP_CONNECT_TIMEOUT = 5
+# Таймаут на чтение ответа (в секундах)
+HTTP_READ_TIMEOUT = 15
+# Общий таймаут на один запрос (в секундах)
+HTTP_TOTAL_TIMEOUT = 30
+# Максимальное количество одновременных запросов ко всем магазинам
+HTTP_MAX_IN_FLIGHT = 20
+# Максимальное количество одновременных соединений с одним магазином
+HTTP_LIMIT_PER_HOST = 5
+# Сколько секунд держать неиспользуемое соединение открытым (keep-alive)
+HTTP_KEEPALIVE_TIMEOUT = 60
 
+# Сколько товаров одного магазина проверять одновременно
+MARKET_CONCURRENCY = {
+    "onliner": 5,
+    "wb": 5,
+    "21vek": 3,
+    "remzona": 2,
+    "shate-mag": 2,
+}
+# Для магазинов, которых нет в списке выше
+MARKET_CONCURRENCY_DEFAULT = 2
+
+# Адаптивный планировщик проверки цен
+# Как часто (в секундах) планировщик ищет товары, которые пора проверить
+SCHEDULER_TICK = 5
+# Минимальный и максимальный интервал проверки одного товара по магазинам (в секундах)
+MARKET_POLL_INTERVAL = {
+    "onliner": (10, 600),
+    "wb": (10, 600),
+    "21vek": (3600, 6 * 60 * 60),
+    "remzona": (3600, 6 * 60 * 60),
+    "shate-mag": (3600, 6 * 60 * 60),
+}
+# Для магазинов, которых нет в списке выше
+MARKET_POLL_INTERVAL_DEFAULT = (600, 6 * 60 * 60)
+# Во сколько раз увеличить интервал, если цена и наличие не изменились
+POLL_INTERVAL_GROWTH = 1.5
+# Во сколько раз уменьшить интервал, если цена или наличие изменились
+POLL_INTERVAL_SHRINK = 0.5
+# Товары, цена которых отличается от порога пользователя не больше чем на этот процент, проверяются с минимальным интервалом
+THRESHOLD_EDGE_PERCENT = 5
+
+# Разбор HTML страниц в отдельных процессах
+# Количество процессов (None - по количеству ядер процессора)
+PARSE_WORKERS = None
+# Максимальное количество страниц, одновременно ожидающих разбора
+PARSE_MAX_PENDING = 50
+
+# Потоковое чтение страниц товаров
+# Размер одного читаемого куска страницы (в байтах)
+STREAM_CHUNK_SIZE = 16 * 1024
+# Сколько байт страницы читать максимум, даже если не все данные найдены, по магазинам
+MARKET_STREAM_MAX_BYTES = {
+    "onliner": 512 * 1024,
+    "21vek": 512 * 1024,
+}
+# Для магазинов, которых нет в списке выше (None - читать страницу целиком)
+MARKET_STREAM_MAX_BYTES_DEFAULT = None
+
+# Защита магазинов от лишних запросов
+# Ограничение частоты запросов к одному хосту: хост -> (запросов в секунду, максимальный запас запросов)
+# например "catalog.onliner.by": (5, 10)
+HOST_RATE_LIMIT = {}
+# Для хостов, которых нет в списке выше
+HOST_RATE_LIMIT_DEFAULT = (5, 10)
+# Сколько раз повторять запрос при ответах 429 / 5xx и ошибках соединения
+HTTP_RETRIES = 3
+# HTTP-статусы, при которых запрос повторяется
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Начальная и максимальная задержка перед повтором (в секундах), задержка растет в 2 раза с каждой попыткой
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30
+# После скольких неудачных запросов подряд перестать обращаться к хосту
+BREAKER_FAILURE_THRESHOLD = 5
+# Через сколько секунд отправить к недоступному хосту пробный запрос
+BREAKER_RESET_TIMEOUT = 60
+# HTTP-статусы, которые относятся к самой странице (товар удален), а не к магазину.
+# Остальные ошибки (403 и другие блокировки ботов, 5xx) считаются отказом хоста
+HTTP_PAGE_ERROR_STATUSES = (404, 410)
+# За какой период (в секундах) считать частоту запросов к хосту
+HOST_STATS_WINDOW = 60
+
+# Пакетная загрузка цен через JSON API магазинов (вместо загрузки страницы каждого товара)
+# Сколько товаров запрашивать одним запросом, по магазинам
+BATCH_API_SIZE = {
+    "onliner": 50,
+    "wb": 100,
+}
+# Адреса API: {ids} / {keys} заменяются на список товаров
+WB_BATCH_API_URL = "https://card.wb.ru/cards/v2/detail?appType=1&curr=byn&dest=-59202&nm={ids}"
+ONLINER_BATCH_API_URL = "https://catalog.onliner.by/sdapi/catalog.api/search/products?{keys}"
+
+# Хранение истории цен
+# Сколько дней хранить подробную историю цен (None - хранить всегда), более старые записи сворачиваются
+PRICE_HISTORY_RETENTION_DAYS = 365
+# Период свертки старой истории: "hour" или "day"
+PRICE_HISTORY_ROLLUP_PERIOD = "day"
+# На сколько месяцев вперед создавать партиции истории цен
+PRICE_HISTORY_PARTITIONS_AHEAD = 2
+
+# Рассылка уведомлений
+# Сколько секунд ждать после уведомления из базы, чтобы собрать изменения вместе
+NOTIFY_DEBOUNCE = 1
+# Как часто (в секундах) проверять товары для рассылки на случай пропущенных уведомлений
+RASSILKA_RECONCILE_INTERVAL = 600
+# Через сколько секунд без уведомлений проверять, что соединение слушателя живо
+NOTIFY_HEALTHCHECK_INTERVAL = 30
+
+# Реплика для чтения (DB_READ_* в .env, если не задана - все запросы идут в основную базу)
+# Сколько секунд после изменений пользователя читать его данные из основной базы
+READ_YOUR_WRITES_WINDOW = 5
+
+# Кэш клавиатур "Мои товары" в Redis
+# Сколько секунд собирать изменения товаров, прежде чем перестроить клавиатуры их пользователей
+KEYBOARD_INVALIDATE_DELAY = 2
+# Максимум соединений в пуле Redis
+REDIS_MAX_CONNECTIONS = 20
+# Таймауты Redis (в секундах): на подключение и на ответ
+REDIS_CONNECT_TIMEOUT = 2
+REDIS_SOCKET_TIMEOUT = 2
+# Сколько клавиатур записывать в Redis одной командой MSET
+REDIS_BATCH_SIZE = 500
+
+# Кэш товаров в памяти процесса (get_product_from_id)
+# Сколько записей хранить (самые давно использованные вытесняются)
+PRODUCT_CACHE_SIZE = 10000
+# Сколько секунд запись считается свежей
+PRODUCT_CACHE_TTL = 300
+
+# Кэш готовых подписей карточек товаров (карточка и рассылка)
+# Сколько подписей хранить
+CARD_CACHE_SIZE = 5000
+# Сколько секунд хранить подпись (обновляется и раньше - при новой записи в истории цен)
+CARD_CACHE_TTL = 3600
@@ -1,10 +1,19 @@
+import datetime
 import logging
 import os
+import re
 import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
 
 import asyncpg
 from dotenv import load_dotenv
 
+from config import (PRICE_HISTORY_PARTITIONS_AHEAD, PRICE_HISTORY_RETENTION_DAYS,
+                    PRICE_HISTORY_ROLLUP_PERIOD, PRODUCT_CACHE_SIZE,
+                    PRODUCT_CACHE_TTL, READ_YOUR_WRITES_WINDOW,)
+
 
 load_dotenv()
 
@@ -18,13 +27,29 @@ DATABASE_CONFIG = {
 }
 
 
+# Реплика для чтения: задается переменными DB_READ_*, не указанные берутся из основной базы
+READ_DATABASE_CONFIG = (
+    {
+        "host": os.getenv("DB_READ_HOST"),
+        "port": int(os.getenv("DB_READ_PORT") or DATABASE_CONFIG["port"]),
+        "user": os.getenv("DB_READ_USER") or DATABASE_CONFIG["user"],
+        "password": os.getenv("DB_READ_PASSWORD") or DATABASE_CONFIG["password"],
+        "database": os.getenv("DB_READ_NAME") or DATABASE_CONFIG["database"],
+    }
+    if os.getenv("DB_READ_HOST")
+    else None
+)
+
+
 # Инициализация глобальной переменной для пула
 pool = None
+# Пул соединений к реплике для чтения
+read_pool = None
 
 
 # Создает и возвращает пул соединений к базе данных.
-async def create_pool():
-    return await asyncpg.create_pool(**DATABASE_CONFIG)
+async def create_pool(config=DATABASE_CONFIG):
+    return await asyncpg.create_pool(**config)
 
 
 # Возвращает пул соединений
@@ -35,19 +60,473 @@ async def get_pool():
     return pool
 
 
-# Закрывает пул соединений
+# Возвращает пул соединений к реплике (или основной, если реплика не настроена)
+async def get_read_pool():
+    global read_pool
+    if READ_DATABASE_CONFIG is None:
+        return await get_pool()
+    if read_pool is None:
+        read_pool = await create_pool(READ_DATABASE_CONFIG)
+    return read_pool
+
+
+# Закрывает пулы соединений
 async def close_pool():
-    global pool
+    global pool, read_pool
     if pool is not None:
         await pool.close()
         pool = None
+    if read_pool is not None:
+        await read_pool.close()
+        read_pool = None
+
+
+# Сессия текущего обработчика или задачи планировщика (см. db_session):
+# {"conns": {"primary" / "read": соединение, взятое при первом обращении}, "transaction", "readonly", "exit": AsyncExitStack}
+current_session = ContextVar("current_session", default=None)
+# Сессия открыта с транзакцией - все запросы только через ее соединение
+current_transaction = ContextVar("current_transaction", default=False)
+# Пользователь, от имени которого выполняется обработчик (для чтения с реплики)
+current_user = ContextVar("current_user", default=None)
+
+# user_id -> время (time.monotonic) последнего изменения данных пользователем
+recent_writes = {}
+
+
+# Запоминаем изменение данных пользователя, чтобы какое-то время читать их из основной базы
+def mark_user_write(user_id):
+    now = time.monotonic()
+    recent_writes[user_id] = now
+    if len(recent_writes) > 1000:  # Убираем устаревшие отметки
+        for key, written in list(recent_writes.items()):
+            if now - written > READ_YOUR_WRITES_WINDOW:
+                del recent_writes[key]
+
+
+# Читаем с реплики только в обработчиках пользователей (фоновым задачам нужны свежие данные),
+# вне транзакции и если пользователь недавно ничего не менял
+def use_read_pool():
+    if READ_DATABASE_CONFIG is None or current_transaction.get():
+        return False
+    user_id = current_user.get()
+    if user_id is None:
+        return False
+    written = recent_writes.get(user_id)
+    return written is None or time.monotonic() - written > READ_YOUR_WRITES_WINDOW
+
+
+# Одно соединение на весь обработчик / задачу: все функции этого модуля внутри блока
+# используют его, а не берут новое соединение из пула. Соединение берется из пула при первом
+# запросе к базе и возвращается при выходе из блока, поэтому долгие запросы к магазинам,
+# отправку сообщений и т.п. в сессию не заворачиваем.
+# transaction=True - все запросы блока в одной транзакции, readonly=True - транзакция только для чтения.
+# user_id - пользователь обработчика: чтения идут на реплику, изменения отмечаются для read-your-writes.
+# Внутри блока нельзя параллельно (asyncio.gather) обращаться к базе - соединение одно.
+@asynccontextmanager
+async def db_session(transaction=False, readonly=False, user_id=None):
+    if current_session.get() is not None:  # Уже внутри сессии - используем ее соединение
+        yield
+        return
+
+    user_token = current_user.set(user_id)
+    transaction_token = current_transaction.set(transaction or readonly)
+    try:
+        async with AsyncExitStack() as exit_stack:
+            session = {
+                "conns": {},
+                "transaction": transaction or readonly,
+                "readonly": readonly,
+                "exit": exit_stack,
+            }
+            token = current_session.set(session)
+            try:
+                yield
+            finally:
+                current_session.reset(token)
+    finally:
+        current_transaction.reset(transaction_token)
+        current_user.reset(user_token)
+
+
+# Соединение сессии с основной базой или с репликой (read=True): при первом обращении
+# берем его из пула (и открываем транзакцию), дальше все запросы сессии к этой базе идут через него
+async def get_session_connection(session, read=False):
+    name = "read" if read else "primary"
+    if name not in session["conns"]:
+        pool = await (get_read_pool() if read else get_pool())
+        conn = await session["exit"].enter_async_context(pool.acquire())
+        if session["transaction"] and not read:
+            await session["exit"].enter_async_context(
+                conn.transaction(readonly=session["readonly"])
+            )
+        session["conns"][name] = conn
+    return session["conns"][name]
+
+
+# Соединение для запроса: readonly=True - функция только читает, ее можно отправить на реплику.
+# Иначе соединение текущей сессии или новое соединение из основного пула.
+@asynccontextmanager
+async def acquire(readonly=False):
+    read = readonly and use_read_pool()
+    session = current_session.get()
+    if session is not None:
+        yield await get_session_connection(session, read)
+    else:
+        pool = await (get_read_pool() if read else get_pool())
+        async with pool.acquire() as conn:
+            yield conn
+
+    user_id = current_user.get()
+    if not readonly and user_id is not None:
+        mark_user_write(user_id)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Кэш товаров в памяти процесса
+# Ограниченный по размеру кэш: записи старше ttl секунд не отдаем,
+# при переполнении вытесняем ту, к которой дольше всего не обращались
+class ProductCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (время записи, значение, версия)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Возвращаем (найдено, значение); version - запись другой версии считается устаревшей
+    def get(self, key, version=None):
+        entry = self.entries.get(key)
+        if (
+            entry is None
+            or time.monotonic() - entry[0] > self.ttl
+            or entry[2] != version
+        ):
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def set(self, key, value, version=None):
+        self.entries[key] = (time.monotonic(), value, version)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Убираем товары из кэша
+    def invalidate(self, product_ids):
+        keys = {("product", int(product_id)) for product_id in product_ids}
+        for key in keys:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+product_cache = ProductCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL)
+# Кого оповестить об изменении товаров (например, другие экземпляры бота через Redis):
+# async callback(product_ids)
+product_invalidation_hooks = []
+
+
+def add_product_invalidation_hook(callback):
+    product_invalidation_hooks.append(callback)
+
+
+# Товары удалены или изменились: чистим свой кэш и оповещаем остальных
+async def invalidate_products(product_ids):
+    product_ids = [int(product_id) for product_id in product_ids]
+    if not product_ids:
+        return
+    product_cache.invalidate(product_ids)
+    for callback in product_invalidation_hooks:
+        try:
+            await callback(product_ids)
+        except Exception as e:
+            logging.exception(f"Ошибка при оповещении об изменении товаров: {e}")
+
+
+def get_product_cache_stats():
+    return product_cache.stats()
+
+
+# -----------------------------------------------------------------------------------------------------------------------Партиции истории цен по месяцам
+# Начало месяца (в секундах UTC), сдвинутого на months месяцев от месяца метки времени
+def month_start(timestamp, months=0):
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    month_index = date.year * 12 + date.month - 1 + months
+    start = datetime.datetime(
+        month_index // 12, month_index % 12 + 1, 1, tzinfo=datetime.timezone.utc
+    )
+    return int(start.timestamp())
+
+
+# Создаем партиции истории цен для месяцев с from_time до to_time (включительно)
+async def create_price_history_partitions(conn, from_time, to_time):
+    start = month_start(from_time)
+    while start <= to_time:
+        end = month_start(start, 1)
+        date = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS product_price_history_y{date.year}m{date.month:02d} "
+            f"PARTITION OF product_price_history FOR VALUES FROM ({start}) TO ({end})"
+        )
+        start = end
+
+
+# Миграция: переносим историю цен в таблицу, разбитую на партиции по месяцам
+async def partition_price_history(conn):
+    await conn.execute("ALTER TABLE product_price_history RENAME TO product_price_history_old")
+    await conn.execute(
+        "ALTER TABLE product_price_history_old "
+        "RENAME CONSTRAINT product_price_history_pkey TO product_price_history_old_pkey"
+    )
+    await conn.execute(
+        "ALTER INDEX product_price_history_product_time_key "
+        "RENAME TO product_price_history_old_product_time_key"
+    )
+    # Последовательность id переходит к новой таблице
+    await conn.execute("ALTER SEQUENCE product_price_history_id_seq OWNED BY NONE")
+    await conn.execute(
+        "CREATE TABLE product_price_history ("
+        "id INT NOT NULL DEFAULT nextval('product_price_history_id_seq'),"
+        "product_id INT NOT NULL,"
+        "product_availability_status VARCHAR(255),"
+        "product_price INT,"
+        "product_data_retrieval_time INT NOT NULL,"
+        "PRIMARY KEY (id, product_data_retrieval_time)) "
+        "PARTITION BY RANGE (product_data_retrieval_time)"
+    )
+    await conn.execute(
+        "CREATE UNIQUE INDEX product_price_history_product_time_key "
+        "ON product_price_history (product_id, product_data_retrieval_time)"
+    )
+    await conn.execute(
+        "CREATE TABLE product_price_history_default PARTITION OF product_price_history DEFAULT"
+    )
+
+    # Записи без времени попадут в партицию по умолчанию
+    first_time = await conn.fetchval(
+        "SELECT MIN(product_data_retrieval_time) FROM product_price_history_old "
+        "WHERE product_data_retrieval_time > 0"
+    )
+    now = int(time.time())
+    await create_price_history_partitions(
+        conn,
+        first_time if first_time is not None else now,
+        month_start(now, PRICE_HISTORY_PARTITIONS_AHEAD),
+    )
+    await conn.execute(
+        "INSERT INTO product_price_history "
+        "SELECT id, product_id, product_availability_status, product_price, "
+        "COALESCE(product_data_retrieval_time, 0) FROM product_price_history_old"
+    )
+    await conn.execute("DROP TABLE product_price_history_old")
+    await conn.execute(
+        "ALTER SEQUENCE product_price_history_id_seq OWNED BY product_price_history.id"
+    )
+
+
+# -----------------------------------------------------------------------------------------------------------------------Отдельное соединение для LISTEN
+# Канал, в который база сообщает ID товаров с новой ценой (см. миграцию 6)
+PRICE_CHANGED_CHANNEL = "price_changed"
+
+
+# Открываем отдельное (не из пула) соединение и подписываемся на канал;
+# callback(connection, pid, channel, payload) вызывается на каждое уведомление
+async def connect_listener(channel: str, callback):
+    conn = await asyncpg.connect(**DATABASE_CONFIG)
+    await conn.add_listener(channel, callback)
+    return conn
+
+
+# -----------------------------------------------------------------------------------------------------------------------Миграции схемы базы данных
+# Список миграций: (версия, описание, шаги). Шаг - SQL-запрос или функция, которая получает соединение.
+# Новые миграции добавляются в конец с новой версией, уже примененные миграции не меняются.
+MIGRATIONS = [
+    (
+        1,
+        "http_validators",
+        [
+            "CREATE TABLE IF NOT EXISTS http_validators ("
+            "url VARCHAR(255) PRIMARY KEY,"
+            "etag VARCHAR(255),"
+            "last_modified VARCHAR(255),"
+            "content_length INT,"
+            "updated_at INT)",
+        ],
+    ),
+    (
+        2,
+        "indexes and unique pairs",
+        [
+            # История цен: последняя цена, min / max, график - все по product_id
+            "CREATE INDEX IF NOT EXISTS product_price_history_product_time_idx "
+            "ON product_price_history (product_id, product_data_retrieval_time DESC)",
+            # Удаляем дубли перед созданием уникальных ограничений (оставляем первую запись)
+            "DELETE FROM user_products a USING user_products b "
+            "WHERE a.user_id = b.user_id AND a.product_id = b.product_id AND a.id > b.id",
+            "ALTER TABLE user_products "
+            "ADD CONSTRAINT user_products_user_product_key UNIQUE (user_id, product_id)",
+            "CREATE INDEX IF NOT EXISTS user_products_product_idx ON user_products (product_id)",
+            "DELETE FROM pool_products a USING pool_products b "
+            "WHERE a.user_id = b.user_id AND a.product_id = b.product_id AND a.id > b.id",
+            "ALTER TABLE pool_products "
+            "ADD CONSTRAINT pool_products_user_product_key UNIQUE (user_id, product_id)",
+            "CREATE INDEX IF NOT EXISTS pool_products_pool_idx ON pool_products (pools_id)",
+            "CREATE INDEX IF NOT EXISTS pool_products_product_idx ON pool_products (product_id)",
+            "CREATE INDEX IF NOT EXISTS user_pools_user_idx ON user_pools (user_id)",
+            "CREATE INDEX IF NOT EXISTS products_url_idx ON products (product_url)",
+            # Товары для рассылки (status = 1) - их обычно мало
+            "CREATE INDEX IF NOT EXISTS products_status_idx ON products (status) WHERE status <> 0",
+        ],
+    ),
+    (
+        3,
+        "product_price_summary",
+        [
+            # Сводка по ценам товара, обновляется при каждой записи новой цены
+            "CREATE TABLE IF NOT EXISTS product_price_summary ("
+            "product_id INT PRIMARY KEY,"
+            "last_history_id INT,"
+            "last_price INT,"
+            "last_status VARCHAR(255),"
+            "last_time INT,"
+            "previous_price INT,"
+            "min_price INT,"
+            "max_price INT,"
+            "distinct_prices INT NOT NULL DEFAULT 0,"
+            "last_change_time INT)",
+            # Заполняем сводку по уже накопленной истории
+            "INSERT INTO product_price_summary ("
+            "product_id, last_history_id, last_price, last_status, last_time, "
+            "previous_price, min_price, max_price, distinct_prices, last_change_time) "
+            "SELECT product_id, "
+            "MAX(id) FILTER (WHERE rn = 1), "
+            "MAX(product_price) FILTER (WHERE rn = 1), "
+            "MAX(product_availability_status) FILTER (WHERE rn = 1), "
+            "MAX(product_data_retrieval_time) FILTER (WHERE rn = 1), "
+            "CASE WHEN COUNT(*) > 1 "
+            "THEN MAX(product_price) FILTER (WHERE rn = 2) "
+            "ELSE MAX(product_price) FILTER (WHERE rn = 1) END, "
+            "MIN(product_price), "
+            "MAX(product_price), "
+            "COUNT(DISTINCT product_price), "
+            "MAX(product_data_retrieval_time) FILTER (WHERE rn = 1) "
+            "FROM ("
+            "    SELECT *, ROW_NUMBER() OVER ("
+            "        PARTITION BY product_id "
+            "        ORDER BY product_data_retrieval_time DESC, id DESC"
+            "    ) AS rn FROM product_price_history"
+            ") h GROUP BY product_id "
+            "ON CONFLICT (product_id) DO NOTHING",
+        ],
+    ),
+    (
+        4,
+        "unique price history per retrieval time",
+        [
+            # Одна запись истории на товар и время проверки - повторная запись того же цикла ничего не добавит
+            "DELETE FROM product_price_history a USING product_price_history b "
+            "WHERE a.product_id = b.product_id "
+            "AND a.product_data_retrieval_time = b.product_data_retrieval_time AND a.id > b.id",
+            "CREATE UNIQUE INDEX IF NOT EXISTS product_price_history_product_time_key "
+            "ON product_price_history (product_id, product_data_retrieval_time)",
+            # Уникальный индекс заменяет индекс из миграции 2
+            "DROP INDEX IF EXISTS product_price_history_product_time_idx",
+        ],
+    ),
+    (
+        5,
+        "partitioned price history and rollups",
+        [
+            partition_price_history,
+            # Свернутая история: цены за период (час / день) старше срока хранения
+            "CREATE TABLE IF NOT EXISTS product_price_rollup ("
+            "product_id INT NOT NULL,"
+            "period_start INT NOT NULL,"
+            "open_price INT,"
+            "close_price INT,"
+            "min_price INT,"
+            "max_price INT,"
+            "open_status VARCHAR(255),"
+            "close_status VARCHAR(255),"
+            "PRIMARY KEY (product_id, period_start))",
+        ],
+    ),
+    (
+        6,
+        "notify on price change",
+        [
+            # Товар отмечен для рассылки (status = 1) - сообщаем слушателям его ID
+            "CREATE OR REPLACE FUNCTION notify_price_changed() RETURNS trigger AS $$ "
+            "BEGIN "
+            "    PERFORM pg_notify('price_changed', NEW.id::text); "
+            "    RETURN NEW; "
+            "END; "
+            "$$ LANGUAGE plpgsql",
+            "DROP TRIGGER IF EXISTS products_price_changed ON products",
+            "CREATE TRIGGER products_price_changed "
+            "AFTER UPDATE OF status ON products "
+            "FOR EACH ROW WHEN (NEW.status = 1) "
+            "EXECUTE FUNCTION notify_price_changed()",
+        ],
+    ),
+]
+
+# Ключ блокировки, чтобы миграции не применялись одновременно из нескольких экземпляров бота
+MIGRATIONS_LOCK_KEY = 774210
+
+
+# Применяем миграции, версия которых больше текущей версии схемы
+async def migrate_db(conn):
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INT PRIMARY KEY,"
+        "description VARCHAR(255),"
+        "applied_at INT)"
+    )
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+    try:
+        current_version = await conn.fetchval(
+            "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+        )
+        for version, description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            async with conn.transaction():  # Каждая миграция применяется целиком или не применяется
+                for statement in statements:
+                    if callable(statement):
+                        await statement(conn)
+                    else:
+                        await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES ($1, $2, $3)",
+                    version,
+                    description,
+                    int(time.time()),
+                )
+            logging.info(f"Применена миграция схемы {version}: {description}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
 
 
 # -----------------------------------------------------------------------------------------------------------------------Инициализация базы данных
 async def init_db():
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             # Создание таблицы users, если она еще не существует
             await conn.execute(
                 "CREATE TABLE IF NOT EXISTS users ("
@@ -109,6 +588,14 @@ async def init_db():
                 "product_price INT,"
                 "product_data_retrieval_time INT)"
             )
+
+            # Применяем миграции схемы, которые еще не применены
+            await migrate_db(conn)
+            # Партиции истории цен на ближайшие месяцы
+            now = int(time.time())
+            await create_price_history_partitions(
+                conn, now, month_start(now, PRICE_HISTORY_PARTITIONS_AHEAD)
+            )
     except asyncpg.PostgresError as e:
         logging.exception(
             f"Ошибка при работе с PostgreSQL - Инициализация базы данных: {e}"
@@ -129,9 +616,8 @@ async def add_new_product(
     user_id: int,
     market: str,
 ):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.transaction():  # Используем транзакцию для безопасного управления
                 # Проверяем, есть ли такой продукт
                 result = await conn.fetch(
@@ -151,9 +637,8 @@ async def add_new_product(
                     )
 
                     # Добавляем данные о ценах, наличии и датах
-                    await conn.execute(
-                        "INSERT INTO product_price_history (product_id, product_availability_status, product_data_retrieval_time, product_price) "
-                        "VALUES ($1, $2, $3, $4)",
+                    await insert_price_history(
+                        conn,
                         product_id,
                         product_availability_status,
                         product_data_retrieval_time,
@@ -172,7 +657,8 @@ async def add_new_product(
                 if not result:
                     # Если не существует, добавляем товар к пользователю
                     await conn.execute(
-                        "INSERT INTO user_products (user_id, product_id) VALUES ($1, $2)",
+                        "INSERT INTO user_products (user_id, product_id) VALUES ($1, $2) "
+                        "ON CONFLICT (user_id, product_id) DO NOTHING",
                         user_id,
                         product_id,
                     )
@@ -183,13 +669,18 @@ async def add_new_product(
 
 # -----------------------------------------------------------------------------------------------------------------------Вынимаем товар из базы
 async def get_product_from_id(product_id):
-    pool = await get_pool()  # Получаем пул соединений
+    found, result = product_cache.get(("product", int(product_id)))
+    if found:
+        return result
+
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Проверяем, есть ли такой продукт
             result = await conn.fetchrow(
                 "SELECT * FROM products WHERE id = $1", int(product_id)
             )
+            if result is not None:
+                product_cache.set(("product", int(product_id)), result)
             return result  # Возвращаем результат, если продукт найден
 
     except Exception as e:
@@ -202,7 +693,6 @@ async def add_to_pool(
     user_id: int,
     product_id: int,
 ):
-    pool = await get_pool()  # Получаем пул соединений
     try:
         # Передаем pool в функцию получения информации о продукте
         product_info = await get_product_from_id(product_id)
@@ -214,7 +704,7 @@ async def add_to_pool(
         pool_title = product_info["product_title"]  # Предполагаем, что это словарь
         pool_image_url = product_info["product_image_url"]
 
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             # Проверяем, есть ли такой пул
             result = await check_pool(
                 user_id, product_id
@@ -232,7 +722,8 @@ async def add_to_pool(
 
                 # Добавляем этот же товар в пул
                 await conn.execute(
-                    "INSERT INTO pool_products (pools_id, product_id, user_id) VALUES ($1, $2, $3)",
+                    "INSERT INTO pool_products (pools_id, product_id, user_id) VALUES ($1, $2, $3) "
+                    "ON CONFLICT (user_id, product_id) DO NOTHING",
                     int(pools_id),
                     int(product_id),
                     int(user_id),
@@ -244,9 +735,8 @@ async def add_to_pool(
 
 # -----------------------------------------------------------------------------------------------------------------------Проверяем есть ли такой пул
 async def check_pool(user_id: int, product_id: int) -> bool:
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Проверяем, есть ли такой пул
             result = await conn.fetchrow(
                 "SELECT 1 FROM user_pools WHERE user_id = $1 AND product_id = $2",
@@ -263,9 +753,8 @@ async def check_pool(user_id: int, product_id: int) -> bool:
 
 # -----------------------------------------------------------------------------------------------------------------------Проверяем есть ли такой товар в пуле
 async def check_pool_product(user_id: int, product_id: int) -> bool:
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Проверяем, есть ли такой товар в пуле
             result = await conn.fetchrow(
                 "SELECT 1 FROM pool_products WHERE user_id = $1 AND product_id = $2",
@@ -280,9 +769,8 @@ async def check_pool_product(user_id: int, product_id: int) -> bool:
 
 # -----------------------------------------------------------------------------------------------------------------------Формируем список пулов пользователя
 async def get_list_pools(user_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем все пулы для указанного пользователя
             result = await conn.fetch(
                 "SELECT * FROM user_pools WHERE user_id = $1", int(user_id)
@@ -297,9 +785,8 @@ async def get_list_pools(user_id: int):
 
 # -----------------------------------------------------------------------------------------------------------------------Формируем список продуктов в пуле пользователя
 async def get_list_product_from_pools(user_id: int, pools_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем все товары из указанного пула для данного пользователя
             result = await conn.fetch(
                 "SELECT * FROM pool_products WHERE user_id = $1 AND pools_id = $2",
@@ -312,52 +799,38 @@ async def get_list_product_from_pools(user_id: int, pools_id: int):
         return None  # Возможно, возвращаем None или другую информацию об ошибке
 
 
-# -----------------------------------------------------------------------------------------------------------------------возвращаем мин цену в пуле
-async def get_min_pool_price(user_id: int, pool_id: int):
+# -----------------------------------------------------------------------------------------------------------------------возвращаем мин цены во всех пулах пользователя
+# Словарь pool_id -> [минимальная текущая цена в пуле, минимальная цена за всю историю среди товаров пула].
+# Учитываются только товары с известной текущей ценой; пулов без цен в словаре нет.
+POOL_MIN_PRICES_SQL = (
+    "SELECT pp.pools_id, "
+    "MIN(s.last_price) AS price_min, "
+    "MIN(COALESCE(NULLIF(s.min_price, 0), s.last_price)) AS price_min_product "
+    "FROM pool_products pp "
+    "JOIN product_price_summary s ON s.product_id = pp.product_id "
+    "WHERE pp.user_id = $1 AND s.last_price IS NOT NULL "
+    "GROUP BY pp.pools_id"
+)
 
-    try:
-        list_product = await get_list_product_from_pools(user_id, pool_id)
-
-        # Проверяем, что список продуктов не пуст
-        if list_product is None or not list_product:
-            logging.warning(f"Нет продуктов в пуле {pool_id}.")
-            return None
-
-        price_min_list = []
-        price_min_product_list =[]
-        for product in list_product:
-            product_id = product["product_id"]
-            product_price = await check_price_product(product_id)
-            product_min_price = await min_price_product(product_id)
-
-            if product_price and product_price[3] is not None:  # Проверка на None
-                price_min_list.append(product_price[3])
-                if product_min_price:
-                    price_min_product_list.append(product_min_price)
-                else:
-                    price_min_product_list.append(product_price[3])
 
-
-        # Проверяем, что список цен не пуст
-        if price_min_list:
-            price_min = min(price_min_list)
-            if price_min_product_list:
-                price_min_product = min(price_min_product_list)
-                return [price_min, price_min_product]
-
-        
-        return [None, None]  # Или любое другое значение, указывающее на отсутствие цен
+async def get_min_pool_prices(user_id: int):
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetch(POOL_MIN_PRICES_SQL, int(user_id))
+            return {
+                row["pools_id"]: [row["price_min"], row["price_min_product"]]
+                for row in result
+            }
 
     except Exception as e:
-        logging.exception(f"Ошибка при получении минимальной цены: {e}")
-        return [None, None]   # Возможно, возвращаем None или другую информацию об ошибке
+        logging.exception(f"Ошибка при получении минимальных цен пулов: {e}")
+        return {}  # Возвращаем пустой словарь в случае ошибки
 
 
 # -----------------------------------------------------------------------------------------------------------------------Добавляем товар в уже созданный пул
 async def append_product_to_pool(user_id: int, pools_id: int, product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
 
             # Проверяем, существует ли уже продукт в пуле
             existing_product = await conn.fetchrow(
@@ -369,7 +842,8 @@ async def append_product_to_pool(user_id: int, pools_id: int, product_id: int):
 
             if existing_product is None:  # Если продукта в пуле нет, добавляем
                 await conn.execute(
-                    "INSERT INTO pool_products (pools_id, product_id, user_id) VALUES ($1, $2, $3)",
+                    "INSERT INTO pool_products (pools_id, product_id, user_id) VALUES ($1, $2, $3) "
+                    "ON CONFLICT (user_id, product_id) DO NOTHING",
                     int(pools_id),
                     int(product_id),
                     int(user_id),
@@ -387,9 +861,8 @@ async def append_product_to_pool(user_id: int, pools_id: int, product_id: int):
 
 
 async def delete_product_from_pool(user_id: int, product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.transaction():  # Используем транзакцию для безопасности
                 # Проверяем, есть ли такой товар в пуле
                 result = await conn.fetchrow(
@@ -428,9 +901,8 @@ async def delete_product_from_pool(user_id: int, product_id: int):
 
 # -----------------------------------------------------------------------------------------------------------------------Возвращаем порог цены для товара
 async def get_threshold(user_id: int, product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Проверяем, есть ли такой товар у пользователя
             result = await conn.fetchrow(
                 "SELECT * FROM user_products WHERE user_id = $1 AND product_id = $2",
@@ -447,9 +919,8 @@ async def get_threshold(user_id: int, product_id: int):
 
 # -----------------------------------------------------------------------------------------------------------------------Добавляем порог цены для товара
 async def add_threshold(user_id: int, product_id: int, threshold: float):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             if threshold is None:
                 # Устанавливаем значение threshold в NULL
                 await conn.execute(
@@ -473,9 +944,8 @@ async def add_threshold(user_id: int, product_id: int, threshold: float):
 
 # -----------------------------------------------------------------------------------------------------------------------Формируем список товаров которые надо обновлять
 async def get_list_product():
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем все продукты из таблицы
             result = await conn.fetch("SELECT * FROM products")
             # Возвращаем только 1-й и 2-й элемент из каждой строки
@@ -483,22 +953,47 @@ async def get_list_product():
             return filtered_result
     except Exception as e:
         logging.exception(f"Ошибка при получении списка продуктов: {e}")
-        return []  # Можно вернуть пустой список или None в случае ошибки
+        return None  # None - список не прочитан (пустой список - товаров нет)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Товары, цена которых около порога пользователя
+# Возвращаем ID товаров из product_ids, у которых последняя цена отличается от порога не больше чем на percent %
+async def get_threshold_edge_products(product_ids: list, percent: float):
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetch(
+                "SELECT DISTINCT up.product_id FROM user_products up "
+                "JOIN product_price_summary s ON s.product_id = up.product_id "
+                "WHERE up.product_id = ANY($1) "
+                "AND up.threshold IS NOT NULL "
+                "AND s.last_price IS NOT NULL "
+                "AND ABS(s.last_price - up.threshold) <= up.threshold * $2 / 100.0",
+                [int(product_id) for product_id in product_ids],
+                float(percent),
+            )
+            return {row[0] for row in result}
+    except Exception as e:
+        logging.exception(f"Ошибка при получении товаров около порога цены: {e}")
+        return set()  # Возвращаем пустое множество в случае ошибки
 
 
 # -----------------------------------------------------------------------------------------------------------------------Проверяем последнюю цену товара
+# Столбцы как в product_price_history: id, product_id, product_availability_status, product_price, product_data_retrieval_time
+LAST_PRICE_COLUMNS = (
+    "last_history_id AS id, "
+    "product_id, "
+    "last_status AS product_availability_status, "
+    "last_price AS product_price, "
+    "last_time AS product_data_retrieval_time"
+)
+
+
 async def check_price_product(product_id):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем последнюю цену для продукта
             result = await conn.fetchrow(
-                "SELECT * FROM product_price_history "
-                "WHERE product_id = $1 "
-                "AND product_data_retrieval_time = ("
-                "    SELECT MAX(product_data_retrieval_time) "
-                "    FROM product_price_history "
-                "    WHERE product_id = $1)",
+                f"SELECT {LAST_PRICE_COLUMNS} FROM product_price_summary WHERE product_id = $1",
                 int(product_id),
             )
 
@@ -512,50 +1007,51 @@ async def check_price_product(product_id):
         return None  # Возвращаем None в случае ошибки
 
 
-# ----------------------------------------------------------------------------------------------------------------------Функция извлечения min и max цен
-async def min_max_price_product(product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
+# -----------------------------------------------------------------------------------------------------------------------Последние цены для списка товаров
+# Возвращаем словарь product_id -> последняя запись о цене одним запросом
+async def check_price_products(product_ids: list):
     try:
-        async with pool.acquire() as conn:
-            # Проверяем наличие хотя бы двух различных цен
-            result = await conn.fetchrow(
-                "SELECT COUNT(DISTINCT product_price) FROM product_price_history WHERE product_id = $1",
-                int(product_id),
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetch(
+                f"SELECT {LAST_PRICE_COLUMNS} FROM product_price_summary WHERE product_id = ANY($1)",
+                [int(product_id) for product_id in product_ids],
             )
-            unique_price_count = result[0] if result else 0
-
-            if unique_price_count < 2:
+            return {row["product_id"]: row for row in result}
+    except Exception as e:
+        logging.exception(f"Ошибка при извлечении последних цен товаров: {e}")
+        return {}  # Возвращаем пустой словарь в случае ошибки
 
-                logging.info(
-                    f"Недостаточно данных для извлечения цен: только {unique_price_count} уникальных записей."
-                )
-                return None  # Возвращаем None, если меньше двух уникальных цен
 
-            # Извлекаем минимальную и максимальную цену
+# ----------------------------------------------------------------------------------------------------------------------Функция извлечения min и max цен
+async def min_max_price_product(product_id: int):
+    try:
+        async with acquire(readonly=True) as conn:
+            # min / max возвращаем, только если было хотя бы две различные цены
             min_max_price = await conn.fetchrow(
-                "SELECT MIN(product_price) AS min_price, MAX(product_price) AS max_price FROM product_price_history WHERE product_id = $1",
+                "SELECT min_price, max_price FROM product_price_summary "
+                "WHERE product_id = $1 AND distinct_prices >= 2",
                 int(product_id),
             )
 
             if min_max_price:
 
                 return min_max_price  # Возвращаем кортеж (min_price, max_price)
-            logging.info("Не найдено цен для данного продукта.")
+            logging.info(
+                f"Недостаточно данных для извлечения цен товара с ID {product_id}."
+            )
 
             return None
 
     except Exception as e:
         logging.exception(f"Ошибка при извлечении цен товара с ID {product_id}: {e}")
-        print(f"Ошибка при извлечении цен товара с ID {product_id}: {e}")
         return None
 
 # ----------------------------------------------------------------------------------------------------------------------Функция извлечения min цен
 async def min_price_product(product_id: int):
-    pool = await get_pool()
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             min_price = await conn.fetchval(
-                "SELECT MIN(product_price) FROM product_price_history WHERE product_id = $1",
+                "SELECT min_price FROM product_price_summary WHERE product_id = $1",
                 int(product_id),
             )
             if min_price is None:
@@ -569,25 +1065,16 @@ async def min_price_product(product_id: int):
 
 # -----------------------------------------------------------------------------------------------------------------------Возвращаем последние 2 записи
 async def check_last_two_price_times(product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
-            # Получаем два последних времени извлечения данных для указанного продукта
-            result = await conn.fetch(
-                "SELECT product_price FROM product_price_history WHERE product_id = $1 "
-                "ORDER BY product_data_retrieval_time DESC LIMIT 2",
+        async with acquire(readonly=True) as conn:
+            # Последняя и предыдущая цена (если запись одна, то обе равны ей)
+            result = await conn.fetchrow(
+                "SELECT last_price, previous_price FROM product_price_summary WHERE product_id = $1",
                 int(product_id),
             )
 
             if result:
-                if len(result) == 1:
-                    # Если найдена только одна запись, возвращаем список с двумя одинаковыми значениями
-                    last_price = result[0][0]
-                    return [last_price, last_price]
-
-                # Если найдено больше одной записи, возвращаем реальные последние два значения
-                last_two_price = [row[0] for row in result]
-                return last_two_price
+                return [result[0], result[1]]
 
             logging.warning(f"Не найдены записи для продукта с ID: {product_id}")
             return None  # Возвращаем None, если записи не найдены
@@ -599,22 +1086,54 @@ async def check_last_two_price_times(product_id: int):
         return None  # Возвращаем None в случае возникновения ошибки
 
 
+# -----------------------------------------------------------------------------------------------------------------------Карточка товара одним запросом
+# Все, что нужно для карточки: товар, последняя и предыдущая цена, min / max,
+# порог пользователя и есть ли товар в его пуле (без user_id - только товар и цены)
+async def get_product_card(product_id: int, user_id: int = None):
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetchrow(
+                "SELECT p.id, p.product_url, p.product_title, p.product_image_url, p.market, "
+                "s.last_history_id, s.last_status, s.last_price, s.last_time, s.previous_price, "
+                "s.min_price, s.max_price, COALESCE(s.distinct_prices, 0) AS distinct_prices, "
+                "up.threshold, "
+                "EXISTS (SELECT 1 FROM pool_products pp "
+                "        WHERE pp.user_id = $2 AND pp.product_id = p.id) AS in_pool "
+                "FROM products p "
+                "LEFT JOIN product_price_summary s ON s.product_id = p.id "
+                "LEFT JOIN user_products up ON up.user_id = $2 AND up.product_id = p.id "
+                "WHERE p.id = $1",
+                int(product_id),
+                int(user_id) if user_id is not None else None,
+            )
+            if result is None:
+                logging.info(f"Нет товара с ID {product_id} для карточки.")
+            return result
+
+    except Exception as e:
+        logging.exception(f"Ошибка при получении карточки товара с ID {product_id}: {e}")
+        return None
+
+
 # -----------------------------------------------------------------------------------------------------------------------Возвращаем все записи для графика
 async def get_all_price_times(product_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
-            # Получаем все данные для указанного продукта
+        async with acquire(readonly=True) as conn:
+            # Получаем все данные для указанного продукта: свернутые периоды (цена закрытия) и подробную историю
             result = await conn.fetch(
-                "SELECT * FROM product_price_history WHERE product_id = $1 "
-                "ORDER BY product_data_retrieval_time",
+                "SELECT product_price, product_data_retrieval_time FROM ("
+                "    SELECT close_price AS product_price, period_start AS product_data_retrieval_time "
+                "    FROM product_price_rollup WHERE product_id = $1 "
+                "    UNION ALL "
+                "    SELECT product_price, product_data_retrieval_time "
+                "    FROM product_price_history WHERE product_id = $1"
+                ") t ORDER BY product_data_retrieval_time",
                 int(product_id),
             )
 
-            # Формируем список пар: (номер по порядку, product_price)
-            # Предполагаем, что product_price находится по индексу 3 и другая информация по индексу 4
+            # Формируем список: (номер по порядку, product_price, product_data_retrieval_time)
             price_list = [
-                (index + 1, row[3], row[4]) for index, row in enumerate(result)
+                (index + 1, row[0], row[1]) for index, row in enumerate(result)
             ]
             return price_list  # Возвращаем результат
 
@@ -625,6 +1144,61 @@ async def get_all_price_times(product_id: int):
         return None  # Возвращаем None в случае возникновения ошибки
 
 
+# -----------------------------------------------------------------------------------------------------------------------Записываем новую цену в историю и обновляем сводку по ценам (в открытой транзакции)
+async def insert_price_history(
+    conn,
+    product_id: int,
+    product_availability_status: str,
+    product_data_retrieval_time: int,
+    product_price: int,
+):
+    # Новая ли это цена для товара (для подсчета различных цен): ищем и в истории, и в свертке
+    is_new_price = product_price is not None and not await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM product_price_history WHERE product_id = $1 AND product_price = $2) "
+        "OR EXISTS (SELECT 1 FROM product_price_rollup WHERE product_id = $1 "
+        "AND $2 IN (open_price, close_price, min_price, max_price))",
+        int(product_id),
+        product_price,
+    )
+    history_id = await conn.fetchval(
+        "INSERT INTO product_price_history ("
+        "product_id, "
+        "product_availability_status, "
+        "product_data_retrieval_time, "
+        "product_price"
+        ") VALUES ($1, $2, $3, $4) "
+        "ON CONFLICT (product_id, product_data_retrieval_time) DO NOTHING RETURNING id",
+        int(product_id),
+        product_availability_status,
+        product_data_retrieval_time,
+        product_price,
+    )
+    if history_id is None:
+        return  # Цена за это время уже записана
+    await conn.execute(
+        "INSERT INTO product_price_summary ("
+        "product_id, last_history_id, last_price, last_status, last_time, "
+        "previous_price, min_price, max_price, distinct_prices, last_change_time"
+        ") VALUES ($1, $2, $3, $4, $5, $3, $3, $3, $6, $5) "
+        "ON CONFLICT (product_id) DO UPDATE SET "
+        "previous_price = product_price_summary.last_price, "
+        "last_history_id = EXCLUDED.last_history_id, "
+        "last_price = EXCLUDED.last_price, "
+        "last_status = EXCLUDED.last_status, "
+        "last_time = EXCLUDED.last_time, "
+        "min_price = LEAST(product_price_summary.min_price, EXCLUDED.min_price), "
+        "max_price = GREATEST(product_price_summary.max_price, EXCLUDED.max_price), "
+        "distinct_prices = product_price_summary.distinct_prices + EXCLUDED.distinct_prices, "
+        "last_change_time = EXCLUDED.last_change_time",
+        int(product_id),
+        history_id,
+        product_price,
+        product_availability_status,
+        product_data_retrieval_time,
+        1 if is_new_price else 0,
+    )
+
+
 # -----------------------------------------------------------------------------------------------------------------------Записываем новую цену
 async def add_new_price_product(
     product_id: int,
@@ -632,40 +1206,116 @@ async def add_new_price_product(
     product_data_retrieval_time: int,
     product_price: float,
 ):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
-            # Записываем новую цену
-            await conn.execute(
-                "INSERT INTO product_price_history ("
-                "product_id, "
-                "product_availability_status, "
-                "product_data_retrieval_time, "
-                "product_price"
-                ") VALUES ($1, $2, $3, $4)",  # Используем $1, $2 и т.д.
-                product_id,
-                product_availability_status,
-                product_data_retrieval_time,
-                product_price,
-            )
+        async with acquire() as conn:
+            async with conn.transaction():  # История, сводка и статус обновляются вместе
+                # Записываем новую цену
+                await insert_price_history(
+                    conn,
+                    product_id,
+                    product_availability_status,
+                    product_data_retrieval_time,
+                    product_price,
+                )
 
-            # Устанавливаем статус для товара
-            await conn.execute(
-                "UPDATE products SET status = 1 WHERE id = $1", int(product_id)
-            )
+                # Устанавливаем статус для товара
+                await conn.execute(
+                    "UPDATE products SET status = 1 WHERE id = $1", int(product_id)
+                )
 
     except Exception as e:
         logging.exception(f"Ошибка при добавлении продукта: {e}")
 
 
+# -----------------------------------------------------------------------------------------------------------------------Записываем новые цены за цикл проверки
+# SQL для записи пакета цен: история, сводка и статус товаров одним запросом
+ADD_NEW_PRICES_SQL = (
+    "WITH new_rows AS ("
+    "    INSERT INTO product_price_history ("
+    "    product_id, product_availability_status, product_data_retrieval_time, product_price) "
+    "    SELECT * FROM unnest($1::int[], $2::varchar[], $3::int[], $4::int[]) "
+    "    ON CONFLICT (product_id, product_data_retrieval_time) DO NOTHING "
+    "    RETURNING id, product_id, product_availability_status, "
+    "    product_data_retrieval_time, product_price"
+    "), "
+    "summary AS ("
+    "    INSERT INTO product_price_summary ("
+    "    product_id, last_history_id, last_price, last_status, last_time, "
+    "    previous_price, min_price, max_price, distinct_prices, last_change_time) "
+    "    SELECT n.product_id, n.id, n.product_price, n.product_availability_status, "
+    "    n.product_data_retrieval_time, n.product_price, n.product_price, n.product_price, "
+    "    CASE WHEN n.product_price IS NOT NULL AND NOT EXISTS ("
+    "        SELECT 1 FROM product_price_history h "
+    "        WHERE h.product_id = n.product_id AND h.product_price = n.product_price"
+    "    ) AND NOT EXISTS ("
+    "        SELECT 1 FROM product_price_rollup r WHERE r.product_id = n.product_id "
+    "        AND n.product_price IN (r.open_price, r.close_price, r.min_price, r.max_price)"
+    "    ) THEN 1 ELSE 0 END, "
+    "    n.product_data_retrieval_time "
+    "    FROM new_rows n "
+    "    ON CONFLICT (product_id) DO UPDATE SET "
+    "    previous_price = product_price_summary.last_price, "
+    "    last_history_id = EXCLUDED.last_history_id, "
+    "    last_price = EXCLUDED.last_price, "
+    "    last_status = EXCLUDED.last_status, "
+    "    last_time = EXCLUDED.last_time, "
+    "    min_price = LEAST(product_price_summary.min_price, EXCLUDED.min_price), "
+    "    max_price = GREATEST(product_price_summary.max_price, EXCLUDED.max_price), "
+    "    distinct_prices = product_price_summary.distinct_prices + EXCLUDED.distinct_prices, "
+    "    last_change_time = EXCLUDED.last_change_time"
+    ") "
+    "UPDATE products SET status = 1 "
+    "WHERE id IN (SELECT product_id FROM new_rows) RETURNING id"
+)
+
+
+# changes - список (product_id, product_availability_status, product_data_retrieval_time, product_price)
+# Пакет записывается одной транзакцией; запись, которая уже есть (тот же товар и время), пропускается,
+# поэтому повтор после ошибки не создаст дублей. Возвращаем ID товаров, для которых записана новая цена,
+# или None, если пакет записать не удалось.
+async def add_new_prices_bulk(changes: list):
+    # На один товар в пакете - одно изменение (последнее)
+    latest = {}
+    for change in changes:
+        latest[int(change[0])] = change
+    if not latest:
+        return []
+
+    columns = list(zip(*latest.values()))
+    for attempt in range(2):  # Повторяем один раз при обрыве соединения
+        try:
+            async with acquire() as conn:
+                async with conn.transaction():
+                    result = await conn.fetch(
+                        ADD_NEW_PRICES_SQL,
+                        [int(product_id) for product_id in columns[0]],
+                        list(columns[1]),
+                        [int(retrieval_time) for retrieval_time in columns[2]],
+                        list(columns[3]),
+                    )
+            changed = [row[0] for row in result]
+            # У изменившихся товаров поменялся статус
+            await invalidate_products(changed)
+            return changed
+        except (
+            asyncpg.PostgresConnectionError,
+            asyncpg.ConnectionDoesNotExistError,
+            ConnectionError,
+        ) as e:
+            logging.warning(f"Обрыв соединения при записи цен, попытка {attempt + 1}: {e}")
+        except Exception as e:
+            logging.exception(f"Ошибка при записи пакета цен: {e}")
+            return None
+    return None
+
+
 # -----------------------------------------------------------------------------------------------------------------------Добавляем нового пользователя
 # Добавление пользователя в базу данных
 async def add_user_db(user_id: int, first_name: str, last_name: str, username: str):
     created_at = int(time.time())
-    pool = await get_pool()  # Получаем пул соединений
 
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             # Проверка, существует ли пользователь в базе данных
             result = await conn.fetchrow(
                 "SELECT * FROM users WHERE user_id = $1", user_id
@@ -708,9 +1358,8 @@ async def add_user_db(user_id: int, first_name: str, last_name: str, username: s
 
 # -----------------------------------------------------------------------------------------------------------------------Извлекаем список товаров для рассылки
 async def get_list_product_for_rassilka(status):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем все продукты из таблицы, которые надо разослать
             result = await conn.fetch(
                 "SELECT * FROM products WHERE status = $1", status
@@ -728,12 +1377,14 @@ async def get_list_product_for_rassilka(status):
 
 # -----------------------------------------------------------------------------------------------------------------------Извлекаем список пользователей для рассылки
 async def get_list_users_for_rassilka(product_id):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
-            # Получаем всех пользователей для указанного продукта
+        async with acquire(readonly=True) as conn:
+            # Получаем всех пользователей для указанного продукта и есть ли товар у них в пуле
             result = await conn.fetch(
-                "SELECT * FROM user_products WHERE product_id = $1", product_id
+                "SELECT up.*, EXISTS (SELECT 1 FROM pool_products pp "
+                "WHERE pp.user_id = up.user_id AND pp.product_id = up.product_id) AS in_pool "
+                "FROM user_products up WHERE up.product_id = $1",
+                product_id,
             )
 
             # Возвращаем результат, если есть, иначе пустой список
@@ -751,11 +1402,10 @@ async def get_list_users_for_rassilka(product_id):
 
 
 async def get_all_users_for_redis():
-    pool = await get_pool()  # get_pool — coroutine, OK
     query = "SELECT * FROM users"
 
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             records = await conn.fetch(query)
             if not records:
                 logging.info("Нет пользователей в таблице users.")
@@ -769,11 +1419,27 @@ async def get_all_users_for_redis():
         return []
 
 
+# Пользователи, у которых есть хотя бы один из товаров (в списке или в пуле)
+async def get_product_subscribers(product_ids: list):
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetch(
+                "SELECT user_id FROM user_products WHERE product_id = ANY($1) "
+                "UNION "
+                "SELECT user_id FROM pool_products WHERE product_id = ANY($1)",
+                [int(product_id) for product_id in product_ids],
+            )
+            return [row["user_id"] for row in result]
+
+    except Exception as e:
+        logging.exception(f"Ошибка при получении пользователей товаров: {e}")
+        return []  # Возвращаем пустой список в случае ошибки
+
+
 # -----------------------------------------------------------------------------------------------------------------------Извлекаем список пользователей для рассылки
 async def change_status_product(status, product_id):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             # Обновляем статус продукта в таблице products
             await conn.execute(
                 "UPDATE products SET status = $1 WHERE id = $2", status, product_id
@@ -782,6 +1448,8 @@ async def change_status_product(status, product_id):
             logging.info(
                 f"Статус продукта с ID {product_id} обновлен на {status}."
             )  # Добавлено логирование успешного обновления
+
+        await invalidate_products([product_id])
     except Exception as e:
         logging.exception(
             f"Ошибка при обновлении статуса продукта с ID {product_id}: {e}"
@@ -790,9 +1458,8 @@ async def change_status_product(status, product_id):
 
 # -----------------------------------------------------------------------------------------------------------------------Получаем список товаров пользователя
 async def get_user_list_product(user_id: int):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             # Получаем все продукты для указанного пользователя
             user_products = await conn.fetch(
                 "SELECT * FROM user_products WHERE user_id = $1", int(user_id)
@@ -822,14 +1489,55 @@ async def get_user_list_product(user_id: int):
         return []  # Возвращаем пустой список в случае ошибки
 
 
+# -----------------------------------------------------------------------------------------------------------------------Список "Мои товары" одним запросом
+# Пулы пользователя с минимальными ценами и товары вне пулов с последней ценой и min / max.
+# Возвращаем {"pools": [...], "products": [...]}; в обоих списках строки с одинаковыми столбцами:
+# id, title, market, price, min_price, max_price, distinct_prices
+USER_LISTING_SQL = (
+    f"WITH pool_prices AS ({POOL_MIN_PRICES_SQL}) "
+    "SELECT 'pool' AS kind, up.id, up.pool_title AS title, NULL AS market, "
+    "m.price_min AS price, m.price_min_product AS min_price, NULL::INT AS max_price, "
+    "0 AS distinct_prices "
+    "FROM user_pools up "
+    "LEFT JOIN pool_prices m ON m.pools_id = up.id "
+    "WHERE up.user_id = $1 "
+    "UNION ALL "
+    "SELECT 'product', p.id, p.product_title, p.market, "
+    "s.last_price, s.min_price, s.max_price, COALESCE(s.distinct_prices, 0) "
+    "FROM user_products u "
+    "JOIN products p ON p.id = u.product_id "
+    "LEFT JOIN product_price_summary s ON s.product_id = p.id "
+    "WHERE u.user_id = $1 AND NOT EXISTS ("
+    "    SELECT 1 FROM pool_products pp WHERE pp.user_id = $1 AND pp.product_id = p.id"
+    ") "
+    "ORDER BY kind, id"
+)
+
+
+# None - не удалось прочитать (пустой список означал бы, что товаров нет)
+async def get_user_listing(user_id: int):
+    listing = {"pools": [], "products": []}
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetch(USER_LISTING_SQL, int(user_id))
+            for row in result:
+                listing[f"{row['kind']}s"].append(row)
+            return listing
+
+    except Exception as e:
+        logging.exception(
+            f"Ошибка при получении списка товаров и пулов пользователя {user_id}: {e}"
+        )
+        return None  # Возвращаем None в случае ошибки
+
+
 # -----------------------------------------------------------------------------------------------------------------------Удаляем товар у пользователя
 # удаляем у пользователя и если больше никто такой товар не отслеживает, то удаляем из базы
 
 
 async def delete_product_from_user(user_id, product_id):
-    pool = await get_pool()  # Получаем пул соединений
     try:
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             # Удаляем продукт из user_products
             await conn.execute(
                 "DELETE FROM user_products WHERE user_id = $1 AND product_id = $2",
@@ -854,6 +1562,131 @@ async def delete_product_from_user(user_id, product_id):
                     "DELETE FROM product_price_history WHERE product_id = $1",
                     int(product_id),
                 )
+                await conn.execute(
+                    "DELETE FROM product_price_summary WHERE product_id = $1",
+                    int(product_id),
+                )
+                await conn.execute(
+                    "DELETE FROM product_price_rollup WHERE product_id = $1",
+                    int(product_id),
+                )
+
+        await invalidate_products([product_id])
 
     except Exception as e:
         logging.exception(f"Ошибка при удалении продукта: {e}")
+
+
+# -----------------------------------------------------------------------------------------------------------------------Возвращаем ETag и Last-Modified для страницы
+async def get_http_validators(url: str):
+    try:
+        async with acquire(readonly=True) as conn:
+            result = await conn.fetchrow(
+                "SELECT etag, last_modified, content_length FROM http_validators WHERE url = $1",
+                url,
+            )
+            return result  # Возвращаем None, если страница еще не загружалась
+    except Exception as e:
+        logging.exception(f"Ошибка при получении валидаторов для {url}: {e}")
+        return None
+
+
+# -----------------------------------------------------------------------------------------------------------------------Записываем ETag и Last-Modified для страницы
+# validators - список (url, etag, last_modified, content_length)
+async def save_http_validators(validators: list):
+    if not validators:
+        return
+    try:
+        now = int(time.time())
+        async with acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO http_validators (url, etag, last_modified, content_length, updated_at) "
+                "VALUES ($1, $2, $3, $4, $5) "
+                "ON CONFLICT (url) DO UPDATE SET "
+                "etag = EXCLUDED.etag, "
+                "last_modified = EXCLUDED.last_modified, "
+                "content_length = EXCLUDED.content_length, "
+                "updated_at = EXCLUDED.updated_at",
+                [(*item, now) for item in validators],
+            )
+    except Exception as e:
+        logging.exception(f"Ошибка при записи валидаторов: {e}")
+
+
+# Удаляем ETag и Last-Modified страниц: следующая проверка загрузит их целиком
+async def delete_http_validators(urls: list):
+    if not urls:
+        return
+    try:
+        async with acquire() as conn:
+            await conn.execute("DELETE FROM http_validators WHERE url = ANY($1)", urls)
+    except Exception as e:
+        logging.exception(f"Ошибка при удалении валидаторов: {e}")
+
+
+# -----------------------------------------------------------------------------------------------------------------------Сворачиваем и удаляем старую историю цен
+# Длительность периода свертки (в секундах)
+ROLLUP_PERIODS = {"hour": 60 * 60, "day": 24 * 60 * 60}
+
+
+# Записи старше PRICE_HISTORY_RETENTION_DAYS сворачиваются в product_price_rollup по периодам
+# PRICE_HISTORY_ROLLUP_PERIOD и удаляются; пустые партиции удаляются целиком.
+# Заодно создаем партиции на ближайшие месяцы.
+async def apply_price_history_retention():
+    try:
+        async with acquire() as conn:
+            now = int(time.time())
+            await create_price_history_partitions(
+                conn, now, month_start(now, PRICE_HISTORY_PARTITIONS_AHEAD)
+            )
+            if not PRICE_HISTORY_RETENTION_DAYS:
+                return
+
+            period = ROLLUP_PERIODS[PRICE_HISTORY_ROLLUP_PERIOD]
+            # Граница по началу периода, чтобы сворачивать только целые периоды
+            cutoff = (now - PRICE_HISTORY_RETENTION_DAYS * 24 * 60 * 60) // period * period
+
+            async with conn.transaction():
+                await conn.execute(
+                    "INSERT INTO product_price_rollup ("
+                    "product_id, period_start, open_price, close_price, min_price, max_price, "
+                    "open_status, close_status) "
+                    "SELECT product_id, period_start, "
+                    "(ARRAY_AGG(product_price ORDER BY product_data_retrieval_time))[1], "
+                    "(ARRAY_AGG(product_price ORDER BY product_data_retrieval_time DESC))[1], "
+                    "MIN(product_price), MAX(product_price), "
+                    "(ARRAY_AGG(product_availability_status ORDER BY product_data_retrieval_time))[1], "
+                    "(ARRAY_AGG(product_availability_status ORDER BY product_data_retrieval_time DESC))[1] "
+                    "FROM ("
+                    "    SELECT *, product_data_retrieval_time / $2 * $2 AS period_start "
+                    "    FROM product_price_history WHERE product_data_retrieval_time < $1"
+                    ") h GROUP BY product_id, period_start "
+                    "ON CONFLICT (product_id, period_start) DO NOTHING",
+                    cutoff,
+                    period,
+                )
+                deleted = await conn.execute(
+                    "DELETE FROM product_price_history WHERE product_data_retrieval_time < $1",
+                    cutoff,
+                )
+
+            # Удаляем партиции, которые целиком старше границы хранения
+            partitions = await conn.fetch(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'product_price_history'"
+            )
+            for row in partitions:
+                match = re.fullmatch(r"product_price_history_y(\d{4})m(\d{2})", row[0])
+                if not match:
+                    continue
+                start = datetime.datetime(
+                    int(match.group(1)), int(match.group(2)), 1, tzinfo=datetime.timezone.utc
+                )
+                if month_start(int(start.timestamp()), 1) <= cutoff:
+                    await conn.execute(f"DROP TABLE IF EXISTS {row[0]}")
+
+            logging.info(f"Свертка истории цен старше {cutoff}: {deleted}")
+    except Exception as e:
+        logging.exception(f"Ошибка при свертке истории цен: {e}")
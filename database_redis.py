@@ -1,12 +1,19 @@
+import asyncio
 import json
 import logging
 import os
+import struct
+import uuid
 
-import redis
+import redis.asyncio as redis
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from dotenv import load_dotenv
 
-from database import get_all_users_for_redis
+from config import (KEYBOARD_INVALIDATE_DELAY, NOTIFY_HEALTHCHECK_INTERVAL,
+                    REDIS_BATCH_SIZE, REDIS_CONNECT_TIMEOUT,
+                    REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT,)
+from database import (add_product_invalidation_hook, get_all_users_for_redis,
+                      get_product_subscribers, get_user_listing, product_cache,)
 from keyboards import user_list_products_keyboard
 
 
@@ -19,11 +26,230 @@ username_redis = os.getenv("REDIS_USERNAME")
 password_redis = os.getenv("REDIS_PASSWORD")
 
 
+# Асинхронный клиент с общим пулом соединений
 r = redis.Redis(
-    host=host_redis,
-    port=port_redis,
-    db=0,
-    username=username_redis,
-    password=password_redis,
-    socket_timeout=2,
+    connection_pool=redis.BlockingConnectionPool(
+        host=host_redis,
+        port=port_redis,
+        db=0,
+        username=username_redis,
+        password=password_redis,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_SOCKET_TIMEOUT,  # Сколько ждать свободного соединения из пула
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+    )
 )
+
+
+# Закрывает соединения с Redis
+async def close_redis():
+    await r.aclose()
+    await r.connection_pool.disconnect()
+
+
+# -----------------------------------------------------------------------------------------------------------------------Формат клавиатур в кэше
+# В Redis храним только (текст, callback_data) кнопок:
+#     b"KB" + версия (1 байт) + число рядов (2 байта),
+#     для каждого ряда число кнопок (1 байт), для каждой кнопки длина и текст, длина и callback_data (UTF-8)
+# При изменении формата увеличиваем версию: старые записи не читаются и перестраиваются
+KEYBOARD_CACHE_MAGIC = b"KB"
+KEYBOARD_CACHE_VERSION = 1
+
+
+def encode_keyboard(keyboard):
+    parts = [KEYBOARD_CACHE_MAGIC, struct.pack(">BH", KEYBOARD_CACHE_VERSION, len(keyboard))]
+    for row in keyboard:
+        parts.append(struct.pack(">B", len(row)))
+        for button in row:
+            for value in (button.text, button.callback_data):
+                data = value.encode("utf-8")
+                parts.append(struct.pack(">H", len(data)))
+                parts.append(data)
+    return b"".join(parts)
+
+
+# Кнопки собираем без проверки pydantic - данные в кэш записали мы сами.
+# Возвращаем None, если запись в другом формате
+def decode_keyboard(data):
+    if data[:2] != KEYBOARD_CACHE_MAGIC:
+        return None
+    version, rows_count = struct.unpack_from(">BH", data, 2)
+    if version != KEYBOARD_CACHE_VERSION:
+        return None
+
+    offset = 5
+    keyboard = []
+    for _ in range(rows_count):
+        (buttons_count,) = struct.unpack_from(">B", data, offset)
+        offset += 1
+        row = []
+        for _ in range(buttons_count):
+            values = []
+            for _ in range(2):
+                (length,) = struct.unpack_from(">H", data, offset)
+                offset += 2
+                values.append(data[offset:offset + length].decode("utf-8"))
+                offset += length
+            row.append(
+                InlineKeyboardButton.model_construct(text=values[0], callback_data=values[1])
+            )
+        keyboard.append(row)
+    return keyboard
+
+
+# -----------------------------------------------------------------------------------------------------------------------Клавиатура "Мои товары" пользователя
+def keyboard_key(user_id):
+    return f"user_list_products_keyboard:{user_id}"
+
+
+# Строим клавиатуру пользователя: (кнопки для ответа, запись для Redis).
+# None - список товаров прочитать не удалось: пустую клавиатуру вместо него не кэшируем
+async def build_user_keyboard(user_id):
+    listing = await get_user_listing(user_id)
+    keyboard = user_list_products_keyboard(listing)
+    if keyboard is None:
+        return None
+    return keyboard, encode_keyboard(keyboard)
+
+
+# Строим клавиатуру пользователя и сохраняем ее в Redis.
+# Возвращаем None, если клавиатуру построить не удалось; если не удалось только сохранить - построенную
+async def redis_user_list_products_keyboard(user_id):
+    try:
+        built = await build_user_keyboard(user_id)
+    except Exception as e:
+        logging.exception(f"Ошибка при построении клавиатуры пользователя {user_id}: {e}")
+        return None
+    if built is None:
+        logging.error(f"Не удалось построить клавиатуру пользователя {user_id}")
+        return None
+    keyboard, data = built
+    try:
+        await r.set(keyboard_key(user_id), data)
+    except Exception as e:
+        logging.exception(f"Ошибка при сохранении клавиатуры пользователя {user_id} в Redis: {e}")
+    return keyboard
+
+
+# Клавиатура пользователя из Redis (если ее нет - строим). None - клавиатуру получить не удалось
+async def get_redis_user_list_products_keyboard(user_id):
+    try:
+        data = await r.get(keyboard_key(user_id))
+        keyboard = decode_keyboard(data) if data is not None else None
+    except Exception as e:
+        logging.exception(f"Ошибка при получении клавиатуры пользователя {user_id} из Redis: {e}")
+        keyboard = None
+    if keyboard is None:  # Нет в кэше, старый формат или Redis недоступен
+        keyboard = await redis_user_list_products_keyboard(user_id)
+    if keyboard is None:
+        return None
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=keyboard)
+
+
+# Перестраиваем клавиатуры пользователей (по умолчанию всех - при запуске бота).
+# В Redis пишем пачками по REDIS_BATCH_SIZE одной командой MSET.
+# Возвращаем пользователей, чьи клавиатуры построить не удалось
+async def update_redis_user_list_products_keyboard(user_ids=None):
+    failed = []
+    try:
+        if user_ids is None:
+            user_ids = [user["user_id"] for user in await get_all_users_for_redis()]
+
+        batch = {}
+        for user_id in user_ids:
+            built = await build_user_keyboard(user_id)
+            if built is None:  # Оставляем в кэше прежнюю клавиатуру
+                logging.error(f"Не удалось построить клавиатуру пользователя {user_id}")
+                failed.append(user_id)
+                continue
+            batch[keyboard_key(user_id)] = built[1]
+            if len(batch) >= REDIS_BATCH_SIZE:
+                await r.mset(batch)
+                batch = {}
+        if batch:
+            await r.mset(batch)
+    except Exception as e:
+        logging.exception(f"Ошибка при обновлении клавиатур в Redis: {e}")
+    return failed
+
+
+# -----------------------------------------------------------------------------------------------------------------------Перестроение клавиатур по изменениям
+# Пользователи, чьи клавиатуры нужно перестроить, и задача, которая это сделает
+pending_keyboard_users = set()
+keyboard_flush_task = None
+
+
+async def flush_keyboard_invalidations():
+    global keyboard_flush_task
+    await asyncio.sleep(KEYBOARD_INVALIDATE_DELAY)
+    user_ids = list(pending_keyboard_users)
+    pending_keyboard_users.clear()
+    # Изменения, пришедшие во время перестроения, запланируют следующую задачу
+    keyboard_flush_task = None
+    failed = await update_redis_user_list_products_keyboard(user_ids)
+    if failed:  # Попробуем еще раз со следующей пачкой
+        invalidate_user_keyboards(failed)
+
+
+# Отмечаем клавиатуры пользователей устаревшими: повторные отметки за
+# KEYBOARD_INVALIDATE_DELAY секунд перестраивают каждую клавиатуру один раз
+def invalidate_user_keyboards(user_ids):
+    global keyboard_flush_task
+    pending_keyboard_users.update(user_ids)
+    if pending_keyboard_users and keyboard_flush_task is None:
+        keyboard_flush_task = asyncio.create_task(flush_keyboard_invalidations())
+
+
+# Цены товаров изменились - перестраиваем клавиатуры только их пользователей
+async def invalidate_products_keyboards(product_ids):
+    if not product_ids:
+        return
+    user_ids = await get_product_subscribers(list(product_ids))
+    invalidate_user_keyboards(user_ids)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Согласование кэша товаров между экземплярами бота
+PRODUCT_CACHE_CHANNEL = "product_cache_invalidate"
+# Чтобы не обрабатывать свои же сообщения
+INSTANCE_ID = uuid.uuid4().hex
+
+
+async def publish_product_invalidation(product_ids):
+    message = {"instance": INSTANCE_ID, "products": product_ids}
+    await r.publish(PRODUCT_CACHE_CHANNEL, json.dumps(message))
+
+
+add_product_invalidation_hook(publish_product_invalidation)
+
+
+# Слушаем изменения товаров от других экземпляров и чистим свой кэш.
+# Ждем сообщения не дольше NOTIFY_HEALTHCHECK_INTERVAL: тишина - не ошибка, просто проверяем соединение
+async def listen_product_invalidations():
+    reconnect = False
+    while True:
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(PRODUCT_CACHE_CHANNEL)
+            if reconnect:
+                # Пока соединения не было, могли пропустить изменения
+                product_cache.clear()
+                reconnect = False
+            while True:
+                message = await pubsub.get_message(timeout=NOTIFY_HEALTHCHECK_INTERVAL)
+                if message is None:
+                    await pubsub.ping()
+                    continue
+                if message["type"] != "message":
+                    continue
+                data = json.loads(message["data"])
+                if data["instance"] != INSTANCE_ID:
+                    product_cache.invalidate(data["products"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(f"Ошибка подписки на изменения товаров в Redis: {e}")
+            reconnect = True
+            await asyncio.sleep(5)
+        finally:
+            await pubsub.aclose()
@@ -1,28 +1,30 @@
 import logging
 import pathlib
 import time
+from typing import Any, Awaitable, Callable, Dict
 
-from aiogram import Router
+from aiogram import BaseMiddleware, F, Router
+from aiogram.dispatcher.flags import get_flag
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, FSInputFile, Message, TelegramObject
 
 from config import LISTOFADMINS
 from database import (add_new_product, add_threshold, add_to_pool, add_user_db,
-                      append_product_to_pool, check_pool_product, check_price_product,
+                      append_product_to_pool, check_pool_product, db_session,
                       delete_product_from_pool, delete_product_from_user,
-                      get_product_from_id, get_threshold, min_max_price_product, min_price_product, )
+                      get_product_card, get_threshold, )
 from database_redis import (get_redis_user_list_products_keyboard,
-                            redis_user_list_products_keyboard,
-                            update_redis_user_list_products_keyboard,)
+                            redis_user_list_products_keyboard,)
 from keyboards import (key_under_exel, key_under_graph, key_under_threshold,
                        main_menu_my_products_keyboard_inline, product_delete_yes,
                        start_keyboard_inline, user_info_product,
                        user_list_pool_add_keyboard,
                        user_list_product_from_pool_keyboard,)
-from script import convert_date_to_str, is_link_belongs_to_site
+from script import is_link_belongs_to_site
+from script_cards import get_card_caption
 from script_export import create_exel, create_image_graph, delete_file
 
 
@@ -35,6 +37,27 @@ class Reg(StatesGroup):
 router = Router()
 
 
+# Один обработчик - одно соединение с базой на все его запросы.
+# Чтения пользователя могут идти на реплику (кроме короткого времени после его изменений).
+# Обработчики с флагом db_session=False (долго ждут магазин) открывают сессию сами только вокруг запросов к базе
+class DbSessionMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if get_flag(data, "db_session") is False:
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        async with db_session(user_id=user.id if user else None):
+            return await handler(event, data)
+
+
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
+
+
 @router.message(CommandStart())
 async def cmd_start(message: Message):
     if message.from_user.id in LISTOFADMINS:
@@ -113,7 +136,7 @@ async def porog(message: Message, state: FSMContext):
         await state.clear()
 
 
-@router.message()
+@router.message(flags={"db_session": False})
 async def all_message(message: Message, state: FSMContext):
     if message.from_user.id in LISTOFADMINS:
         await state.clear()
@@ -124,21 +147,21 @@ async def all_message(message: Message, state: FSMContext):
             if result and result[0] and result[1]:
                 current_time = int(time.time())
 
-                await add_new_product(
-                    result[1],
-                    result[0],
-                    result[2],
-                    result[3],
-                    result[4],
-                    current_time,
-                    0,
-                    message.from_user.id,
-                    result[5],
-                )
+                async with db_session(user_id=message.from_user.id):
+                    await add_new_product(
+                        result[1],
+                        result[0],
+                        result[2],
+                        result[3],
+                        result[4],
+                        current_time,
+                        0,
+                        message.from_user.id,
+                        result[5],
+                    )
+                    await redis_user_list_products_keyboard(message.from_user.id)
 
                 texttg = f"Товар <i><b>'{result[0]}'</b></i> добавлен и отслеживается."
-                await update_redis_user_list_products_keyboard()
-                await redis_user_list_products_keyboard(message.from_user.id)
                 await message.answer(
                     texttg,
                     reply_markup=start_keyboard_inline,
@@ -160,6 +183,120 @@ async def all_message(message: Message, state: FSMContext):
             )
 
 
+# Карточка товара, график и Exel долго отправляются в Telegram (а график и Exel еще и строятся),
+# поэтому сессию с базой открываем только на время загрузки данных (флаг db_session=False)
+@router.callback_query(F.data.startswith("id_"), flags={"db_session": False})
+async def callback_product_card(callback: CallbackQuery, state: FSMContext):
+    if callback.message.chat.id in LISTOFADMINS:
+        await state.clear()
+        product_id = callback.data.split("_")[1]
+        async with db_session(user_id=callback.message.chat.id):
+            card = await get_product_card(product_id, callback.message.chat.id)
+            if card is None:
+                return
+            reply_markup = await user_info_product(
+                callback.message.chat.id, product_id, card["in_pool"]
+            )
+
+        photo = card["product_image_url"]
+        caption = await get_card_caption(card, "card")
+        try:
+            await callback.message.answer_photo(
+                photo=photo,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML,
+            )
+        except Exception:
+            await callback.message.answer(
+                text=caption,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML,
+            )  # Сообщаем пользователю об ошибке
+
+
+# Без сессии: каждый запрос create_image_graph сразу возвращает соединение в пул
+@router.callback_query(F.data.startswith("graph_"), flags={"db_session": False})
+async def callback_graph(callback: CallbackQuery, state: FSMContext):
+    if callback.message.chat.id in LISTOFADMINS:
+        await state.clear()
+        product_id = callback.data.split("_")[1]
+
+        create_check = await create_image_graph(product_id)
+
+        if create_check:
+            # Путь к сохраненному изображению
+            image_path = f"export/graphs/{product_id}.png"
+
+            # Проверяем, существует ли файл
+            if pathlib.Path(image_path).exists():
+                # Создаем объект для фотографии
+
+                photo = FSInputFile(image_path)
+
+                # Отправляем фотографию с текстом
+                await callback.message.answer_photo(
+                    photo=photo,
+                    reply_markup=await key_under_graph(product_id),
+                    parse_mode=ParseMode.HTML,
+                )
+
+            else:
+                await callback.message.answer(
+                    "Извините, график не найден. Попробуйте позже.",
+                    reply_markup=await key_under_graph(product_id),
+                    parse_mode=ParseMode.HTML,
+                )
+            await delete_file(image_path)
+
+        else:
+            await callback.message.answer(
+                "Извините, не удалось создать график. Попробуйте позже.",
+                reply_markup=await key_under_graph(product_id),
+                parse_mode=ParseMode.HTML,
+            )
+
+
+# Без сессии: каждый запрос create_exel сразу возвращает соединение в пул
+@router.callback_query(F.data.startswith("exel_"), flags={"db_session": False})
+async def callback_exel(callback: CallbackQuery, state: FSMContext):
+    if callback.message.chat.id in LISTOFADMINS:
+        await state.clear()  # Исправлено
+        product_id = callback.data.split("_")[1]
+        create_check = await create_exel(product_id)
+        if create_check:
+            # Путь к сохраненному файлу exel
+            exel_path = f"export/exels/{product_id}.xlsx"
+
+            # Проверяем, существует ли файл
+            if pathlib.Path(exel_path).exists():
+                # Создаем объект для файла exel
+
+                exel = FSInputFile(exel_path)
+
+                # Отправляем документ
+                await callback.message.answer_document(
+                    exel,
+                    reply_markup=await key_under_exel(product_id),
+                    parse_mode=ParseMode.HTML,
+                )
+
+            else:
+                await callback.message.answer(
+                    "Извините, файл Exel не найден. Попробуйте позже.",
+                    reply_markup=await key_under_exel(product_id),
+                    parse_mode=ParseMode.HTML,
+                )
+            await delete_file(exel_path)
+
+        else:
+            await callback.message.answer(
+                "Извините, не удалось создать файл Exel. Попробуйте позже.",
+                reply_markup=await key_under_exel(product_id),
+                parse_mode=ParseMode.HTML,
+            )
+
+
 @router.callback_query()
 async def callback_query(callback: CallbackQuery, state: FSMContext):
     if callback.message.chat.id in LISTOFADMINS:
@@ -171,7 +308,10 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 callback.message.chat.id
             )
 
-            if str(reply_markup_check) != "inline_keyboard=[]":
+            if reply_markup_check is None:
+                text = "Не удалось загрузить список товаров. Попробуйте позже."
+                reply_markup = start_keyboard_inline
+            elif reply_markup_check.inline_keyboard:
                 text = (
                     "<b>Список отслеживаемых товаров:</b>\n"
                     "🌟 - В наличии.\n"
@@ -186,70 +326,6 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
             )
 
-        elif data.startswith("id_"):
-            await state.clear()
-            product_id = data.split("_")[1]
-            product_info = await get_product_from_id(product_id)
-            product_price = await check_price_product(product_id)
-            min_max = await min_max_price_product(product_id)
-            print(min_max)
-
-            if min_max:
-                min_max_str = f"<b>Мин. / Макс. цена:</b> {round(float(min_max[0])/100, 2)} / {round(float(min_max[1])/100, 2)} BYN\n"
-                if product_price[3] == min_max[0]:
-                    super_price = "✅ Самая низкая цена\n"
-                else:
-                    super_price = ""
-
-            else:
-                if product_price[3]:
-                    min_max_str = f"<b>Мин. / Макс. цена:</b> {round(float(product_price[3])/100, 2)} BYN\n"
-                else:
-                    min_price = await min_price_product(product_id)
-                    if min_price:
-                        min_max_str = f"<b>Мин. / Макс. цена:</b> {round(float(min_price)/100, 2)} BYN\n"
-                    else:
-                        min_max_str = ""
-                super_price = ""
-
-            photo = product_info[3]
-            timeadd = product_price[4]
-            timestr = await convert_date_to_str(timeadd, 3)
-
-            if product_price[3]:
-                text_price = (
-                    f"<b>Цена:</b> {round(float(product_price[3])/100, 2)} BYN\n"
-                )
-            else:
-                text_price = ""
-
-            caption = (
-                f"<b>Магазин:</b> {product_info[5]}\n"
-                f'<b>Товар:</b> <a href="{product_info[1]}">{product_info[2]}</a>\n'
-                f"<b>Статус:</b> {product_price[2]}\n\n"
-                f"{text_price}"
-                f"{super_price}"
-                f"{min_max_str}"
-                f"Последнее изменение: {timestr}"
-            )
-            try:
-                await callback.message.answer_photo(
-                    photo=photo,
-                    caption=caption,
-                    reply_markup=await user_info_product(
-                        callback.message.chat.id, product_id
-                    ),
-                    parse_mode=ParseMode.HTML,
-                )
-            except Exception:
-                await callback.message.answer(
-                    text=caption,
-                    reply_markup=await user_info_product(
-                        callback.message.chat.id, product_id
-                    ),
-                    parse_mode=ParseMode.HTML,
-                )  # Сообщаем пользователю об ошибке
-
         elif data.startswith("delete_"):  # Исправлено
             product_id = data.split("_")[1]
             await callback.message.answer(
@@ -257,14 +333,12 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 reply_markup=await product_delete_yes(product_id),
                 parse_mode=ParseMode.HTML,
             )
-            await update_redis_user_list_products_keyboard()
-            await redis_user_list_products_keyboard(callback.message.chat.id)
 
         elif data.startswith("createpool_"):  # Исправлено
             product_id = data.split("_")[1]
             if await check_pool_product(callback.message.chat.id, product_id) is False:
                 await add_to_pool(callback.message.chat.id, product_id)
-                await update_redis_user_list_products_keyboard()
+                await redis_user_list_products_keyboard(callback.message.chat.id)
                 await callback.message.answer(
                     "Cоздан новый пул из этого товара",
                     reply_markup=main_menu_my_products_keyboard_inline,
@@ -282,7 +356,6 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                     ),
                     parse_mode=ParseMode.HTML,
                 )
-            await update_redis_user_list_products_keyboard()
 
         elif data.startswith("appendpool_"):  # Исправлено
             pool_id = data.split("_")[1]
@@ -292,7 +365,7 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 await append_product_to_pool(
                     callback.message.chat.id, pool_id, product_id
                 )
-                await update_redis_user_list_products_keyboard()
+                await redis_user_list_products_keyboard(callback.message.chat.id)
 
                 await callback.message.answer(
                     "Товар добавлен в пул",
@@ -311,13 +384,12 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 ),
                 parse_mode=ParseMode.HTML,
             )  # Сообщаем пользователю об ошибке
-            await redis_user_list_products_keyboard(callback.message.chat.id)
 
         elif data.startswith("delpool_"):
             await state.clear()  # Исправлено
             product_id = data.split("_")[1]
             await delete_product_from_pool(callback.message.chat.id, product_id)
-            await update_redis_user_list_products_keyboard()
+            await redis_user_list_products_keyboard(callback.message.chat.id)
 
             await callback.message.answer(
                 "Товар удален из пула",
@@ -334,81 +406,7 @@ async def callback_query(callback: CallbackQuery, state: FSMContext):
                 reply_markup=start_keyboard_inline,
                 parse_mode=ParseMode.HTML,
             )
-            await update_redis_user_list_products_keyboard()
-
-        elif data.startswith("graph_"):  # Исправлено
-            await state.clear()
-            product_id = data.split("_")[1]
-
-            create_check = await create_image_graph(product_id)
-
-            if create_check:
-                # Путь к сохраненному изображению
-                image_path = f"export/graphs/{product_id}.png"
-
-                # Проверяем, существует ли файл
-                if pathlib.Path(image_path).exists():
-                    # Создаем объект для фотографии
-
-                    photo = FSInputFile(image_path)
-
-                    # Отправляем фотографию с текстом
-                    await callback.message.answer_photo(
-                        photo=photo,
-                        reply_markup=await key_under_graph(product_id),
-                        parse_mode=ParseMode.HTML,
-                    )
-
-                else:
-                    await callback.message.answer(
-                        "Извините, график не найден. Попробуйте позже.",
-                        reply_markup=await key_under_graph(product_id),
-                        parse_mode=ParseMode.HTML,
-                    )
-                await delete_file(image_path)
-
-            else:
-                await callback.message.answer(
-                    "Извините, не удалось создать график. Попробуйте позже.",
-                    reply_markup=await key_under_graph(product_id),
-                    parse_mode=ParseMode.HTML,
-                )
-
-        elif data.startswith("exel_"):
-            await state.clear()  # Исправлено
-            product_id = data.split("_")[1]
-            create_check = await create_exel(product_id)
-            if create_check:
-                # Путь к сохраненному файлу exel
-                exel_path = f"export/exels/{product_id}.xlsx"
-
-                # Проверяем, существует ли файл
-                if pathlib.Path(exel_path).exists():
-                    # Создаем объект для файла exel
-
-                    exel = FSInputFile(exel_path)
-
-                    # Отправляем документ
-                    await callback.message.answer_document(
-                        exel,
-                        reply_markup=await key_under_exel(product_id),
-                        parse_mode=ParseMode.HTML,
-                    )
-
-                else:
-                    await callback.message.answer(
-                        "Извините, файл Exel не найден. Попробуйте позже.",
-                        reply_markup=await key_under_exel(product_id),
-                        parse_mode=ParseMode.HTML,
-                    )
-                await delete_file(exel_path)
-
-            else:
-                await callback.message.answer(
-                    "Извините, не удалось создать файл Exel. Попробуйте позже.",
-                    reply_markup=await key_under_exel(product_id),
-                    parse_mode=ParseMode.HTML,
-                )
+            await redis_user_list_products_keyboard(callback.message.chat.id)
 
         elif data.startswith("threshold_"):
 
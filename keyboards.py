@@ -3,8 +3,7 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from database import (
     check_pool_product, check_price_product, get_list_pools,
-    get_list_product_from_pools, get_min_pool_price, get_product_from_id,
-    get_user_list_product, min_max_price_product,)
+    get_list_product_from_pools, get_product_from_id, min_max_price_product,)
 
 
 # -----------------------------------------------------------------------------------------------------------------------кнопки
@@ -39,90 +38,62 @@ main_menu_keyboard_inline = InlineKeyboardMarkup(inline_keyboard=[[button_main_m
 
 
 # -----------------------------------------------------------------------------------------------------------------------клавиатура списка пулов + товары
-async def user_list_products_keyboard(user_id):
+# listing - результат get_user_listing: только форматирование, без запросов к базе.
+# None - клавиатуру построить не удалось (в кэш ее не пишем)
+def user_list_products_keyboard(listing):
     keyboard = []
 
+    if listing is None:
+        return None
+
     try:
-        pools = await get_list_pools(user_id)
-        # Проверка на получение пулов
-        if not pools:
-            keyboard = []
-        else:
-            for pool in pools:
-                title = pool[3]
-                pool_id = pool[0]
-                pool_min_price_list = await get_min_pool_price(user_id, pool_id)
-                pool_min_price = pool_min_price_list[0]
-
-                product_min_price = pool_min_price_list[1]
-
-                if pool_min_price:
-                    pool_min_price_str = str(round(float(pool_min_price) / 100, 2))
-                    if pool_min_price == product_min_price and pool_min_price is not None:
-                        circle = "✅ "
-                    elif pool_min_price > product_min_price:
-                        circle = "🌟 "
-                    else:
-                        circle = ""
+        # Без товаров пустая клавиатура
+        if not listing["products"] and not listing["pools"]:
+            return keyboard
+
+        for pool in listing["pools"]:
+            title = pool["title"]
+            pool_min_price = pool["price"]
+            product_min_price = pool["min_price"]
+
+            if pool_min_price:
+                pool_min_price_str = str(round(float(pool_min_price) / 100, 2))
+                if pool_min_price == product_min_price:
+                    circle = "✅ "
+                elif pool_min_price > product_min_price:
+                    circle = "🌟 "
                 else:
+                    circle = ""
+            else:
+                circle = "❌ "
+                pool_min_price_str = ""
 
-                    circle = "❌ "
-                    pool_min_price_str = ""
-
-                pool_id = f"pool_{pool_id!s}"
+            text_keyboard = f"{circle}ПУЛ - {pool_min_price_str} -{title}"
+            button = InlineKeyboardButton(text=text_keyboard, callback_data=f"pool_{pool['id']!s}")
+            keyboard.append([button])  # Каждая кнопка в отдельной строке
 
-                text_keyboard = f"{circle}ПУЛ - {pool_min_price_str} -{title}"
-                button = InlineKeyboardButton(text=text_keyboard, callback_data=pool_id)
-                keyboard.append([button])  # Каждая кнопка в отдельной строке
+        for product in listing["products"]:
+            price = product["price"]
+            if not price:
+                circle = "❌ "
+            elif product["distinct_prices"] >= 2 and price == product["min_price"]:
+                circle = "✅ "
+            else:
+                circle = "🌟 "
 
-        products = await get_user_list_product(user_id)
+            if price is not None:
+                text_keyboard = f"{circle} {round(float(price)/100,2)} - {product['market']} - {product['title']}"
+            else:
+                text_keyboard = f"{circle} - {product['market']} - {product['title']}"
 
-        # Проверка на получение продуктов
-        if not products:
-            return InlineKeyboardMarkup(
-                inline_keyboard=[]
-            )  # Возвращаем пустую клавиатуру, если нет продуктов
-
-        for product in products:
-            if await check_pool_product(user_id, product[0]) == False:
-                title = product[2]
-
-                price = await check_price_product(product[0])
-
-                min_max = await min_max_price_product(product[0])
-                product_id = "id_" + str(product[0])  # Преобразуем product_id в строку
-                # print(product_id)
-                try:
-                    if round(price[3], 2) == None or round(price[3], 2) == 0:
-                        circle = "❌ "
-                    elif min_max:
-                        if round(price[3], 2) == round(min_max[0], 2):
-                            circle = "✅ "
-                        else:
-                            circle = "🌟 "
-                    else:
-                        circle = "🌟 "
-                except:
-                    circle = "❌ "
-                try:
-                    text_keyboard = (
-                        f"{circle} {round(float(price[3])/100,2)} - {product[5]} - {title}"
-                        )
-                except:
-                    logging.exception('ошибка text_keyboard')
-                    text_keyboard = (
-                        f"{circle} - {product[5]} - {title}"
-                        )
-                button = InlineKeyboardButton(
-                    text=text_keyboard, callback_data=product_id
-                )
-                keyboard.append([button])  # Каждая кнопка в отдельной строке
+            button = InlineKeyboardButton(
+                text=text_keyboard, callback_data=f"id_{product['id']!s}"
+            )
+            keyboard.append([button])  # Каждая кнопка в отдельной строке
 
     except Exception as e:
         logging.exception(f"An error occurred - user_list_products_keyboard: {e}")  # Логирование ошибки
-        return InlineKeyboardMarkup(
-            inline_keyboard=[]
-        )  # Возвращаем пустую клавиатуру при ошибке
+        return None  # Возвращаем None при ошибке
 
     keyboard.append([button_main_menu])
     # Возвращаем созданную клавиатуру
@@ -224,8 +195,11 @@ async def user_list_product_from_pool_keyboard(user_id, poll_id):
 
 
 # -----------------------------------------------------------------------------------------------------------------------клавиатура в карточке товара
-async def user_info_product(user_id, product_id):
-    if await check_pool_product(user_id, product_id) == False:
+# in_pool - уже известно, есть ли товар в пуле (например, из get_product_card), иначе проверяем в базе
+async def user_info_product(user_id, product_id, in_pool=None):
+    if in_pool is None:
+        in_pool = await check_pool_product(user_id, product_id)
+    if in_pool == False:
         pool_key = [
             InlineKeyboardButton(
                 text="Создать новый пул", callback_data=f"createpool_{product_id}"
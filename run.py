@@ -8,12 +8,15 @@ from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
 
 # Импорт переменных из файла config
-from config import CHECKINTERVAL
-from database import close_pool, init_db
+from config import RASSILKA_RECONCILE_INTERVAL, SCHEDULER_TICK
+from database import apply_price_history_retention, close_pool, init_db
 # Импорт пользовательских функций
 from handlers import router
-from scripts_scheduler import price_update_interval, rassilka_for_users, price_update_cron
-from database_redis import update_redis_user_list_products_keyboard
+from script import close_parse_executor, close_session, start_parse_executor
+from scripts_scheduler import (listen_price_changes, price_update_adaptive,
+                               rassilka_for_users,)
+from database_redis import (close_redis, listen_product_invalidations,
+                            update_redis_user_list_products_keyboard,)
 
 
 load_dotenv()
@@ -25,24 +28,30 @@ async def main():
     # Создаем базу данных, если ее нет.
 
     await init_db()
+    # Запускаем процессы для разбора страниц магазинов
+    await start_parse_executor()
     await update_redis_user_list_products_keyboard()
-    # раскоментить перед продом
-    await price_update_interval()
     scheduler = AsyncIOScheduler(timezone="Europe/Minsk")
-    # Запускаем проверку цен
+    # Запускаем проверку цен: каждый товар проверяется со своим интервалом.
+    # Первый тик идет в фоне, поллинг не ждет первой проверки
     scheduler.add_job(
-        price_update_interval, trigger="interval", seconds=CHECKINTERVAL, max_instances=1
+        price_update_adaptive, trigger="interval", seconds=SCHEDULER_TICK, max_instances=1
     )
+    # Сворачиваем старую историю цен и создаем партиции на следующие месяцы
     scheduler.add_job(
-        price_update_cron, trigger=CronTrigger(hour="3,9,15", minute="00"), max_instances=1
+        apply_price_history_retention, trigger=CronTrigger(hour=4, minute=30), max_instances=1
     )
 
 
-    # Запускаем рассылку для пользователей
+    # Чистим кэш товаров по изменениям из других экземпляров бота
+    cache_listener = asyncio.create_task(listen_product_invalidations())
+    # Запускаем рассылку для пользователей сразу после изменения цены
+    listener = asyncio.create_task(listen_price_changes(bot))
+    # и по расписанию - на случай пропущенных уведомлений
     scheduler.add_job(
         rassilka_for_users,
         trigger="interval",
-        seconds=CHECKINTERVAL + 100,
+        seconds=RASSILKA_RECONCILE_INTERVAL,
         kwargs={
             "bot": bot,
         },
@@ -55,7 +64,12 @@ async def main():
     dp.include_router(router)
     # Запускаем поллинг
     await dp.start_polling(bot)
+    listener.cancel()
+    cache_listener.cancel()
+    await close_session()
+    await close_parse_executor()
     await close_pool()
+    await close_redis()
 
 
 if __name__ == "__main__":
@@ -1,20 +1,282 @@
+import asyncio
+import codecs
+import json
 import logging
+import multiprocessing
+import os
+import random
+import re
+import statistics
 import time
-from urllib.parse import urlparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from urllib.parse import urlencode, urlparse
 
-import requests
+import aiohttp
 
+from config import (BATCH_API_SIZE, BREAKER_FAILURE_THRESHOLD,
+                    BREAKER_RESET_TIMEOUT, HOST_RATE_LIMIT, HOST_RATE_LIMIT_DEFAULT,
+                    HOST_STATS_WINDOW, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX,
+                    HTTP_CONNECT_TIMEOUT, HTTP_KEEPALIVE_TIMEOUT,
+                    HTTP_LIMIT_PER_HOST, HTTP_MAX_IN_FLIGHT, HTTP_READ_TIMEOUT,
+                    HTTP_PAGE_ERROR_STATUSES, HTTP_RETRIES, HTTP_RETRY_STATUSES,
+                    HTTP_TOTAL_TIMEOUT,
+                    MARKET_CONCURRENCY, ONLINER_BATCH_API_URL,
+                    MARKET_CONCURRENCY_DEFAULT, MARKET_STREAM_MAX_BYTES,
+                    MARKET_STREAM_MAX_BYTES_DEFAULT, PARSE_MAX_PENDING,
+                    PARSE_WORKERS, STREAM_CHUNK_SIZE, WB_BATCH_API_URL,)
+from database import (add_new_prices_bulk, check_price_products,
+                      delete_http_validators, get_http_validators,
+                      save_http_validators,)
 
 
+# Инициализация глобальной переменной для HTTP-сессии
+session = None
 
-# -----------------------------------------------------------------------------------------------------------------------
-async def get_item_from_url(url, number_header):
+# Ограничивает общее количество одновременных запросов к магазинам
+http_semaphore = asyncio.Semaphore(HTTP_MAX_IN_FLIGHT)
+
+# Контекст проверки цены товара: если задан, get_item_from_url делает условный запрос
+# (If-None-Match / If-Modified-Since) и при ответе 304 ставит флаг "not_modified".
+# Новые ETag / Last-Modified складываются в context["validators"] (url -> ...), а записывает их
+# check_price - только после того, как страница разобрана и цены записаны в базу
+fetch_context = ContextVar("fetch_context", default=None)
+
+# ETag / Last-Modified страниц, загруженные из базы (url -> (etag, last_modified, content_length))
+http_validators = {}
+
+# Счетчики кеша условных запросов по магазинам: market -> {"hits", "misses", "bytes_saved"}
+http_cache_stats = {}
+
+
+# Создает и возвращает HTTP-сессию с keep-alive соединениями к магазинам
+async def create_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_MAX_IN_FLIGHT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        sock_connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+# Возвращает HTTP-сессию
+async def get_session():
+    global session
+    if session is None or session.closed:
+        session = await create_session()
+    return session
+
+
+# Закрывает HTTP-сессию
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
+
+
+# Возвращает счетчики кеша условных запросов
+def get_http_cache_stats():
+    return {market: dict(item) for market, item in http_cache_stats.items()}
+
+
+# Возвращает сохраненные ETag / Last-Modified для страницы
+async def get_validators(url):
+    if url not in http_validators:
+        result = await get_http_validators(url)
+        http_validators[url] = tuple(result) if result else None
+    return http_validators[url]
+
+
+# -----------------------------------------------------------------------------------------------------------------------Ограничение запросов к магазинам
+# Token bucket для каждого хоста: host -> {"tokens": ..., "updated": ...}
+host_buckets = {}
+
+# Circuit breaker для каждого хоста: host -> {"state": "closed" / "open" / "half-open", "failures": ..., "opened_at": ...}
+host_breakers = {}
+
+# Время последних запросов к каждому хосту (для подсчета частоты): host -> deque
+host_requests = {}
+
+
+# Ждем, пока для хоста не появится свободный токен
+async def acquire_host_token(host):
+    rate, burst = HOST_RATE_LIMIT.get(host, HOST_RATE_LIMIT_DEFAULT)
+    bucket = host_buckets.setdefault(host, {"tokens": burst, "updated": time.monotonic()})
+    while True:
+        now = time.monotonic()
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return
+        await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+
+# Запоминаем время запроса к хосту
+def record_host_request(host):
+    now = time.monotonic()
+    requests_times = host_requests.setdefault(host, deque())
+    requests_times.append(now)
+    while requests_times and requests_times[0] < now - HOST_STATS_WINDOW:
+        requests_times.popleft()
+
+
+# Задержка перед повтором: экспоненциальная, со случайным разбросом, с учетом Retry-After
+def backoff_delay(attempt, retry_after=None):
+    delay = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2**attempt)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(HTTP_BACKOFF_MAX, int(retry_after)))
+    return delay
+
+
+def get_breaker(host):
+    return host_breakers.setdefault(
+        host, {"state": "closed", "failures": 0, "opened_at": 0.0}
+    )
 
-    if number_header == 1:
 
+# Можно ли сейчас отправить запрос к хосту (для открытого breaker пропускаем один пробный запрос)
+def breaker_allow(host):
+    breaker = get_breaker(host)
+    if breaker["state"] == "closed":
+        return True
+    if (
+        breaker["state"] == "open"
+        and time.monotonic() - breaker["opened_at"] >= BREAKER_RESET_TIMEOUT
+    ):
+        breaker["state"] = "half-open"
+        return True
+    return False
 
 
+# Хост недоступен и пробный запрос еще рано (или уже) отправлять
+def is_host_blocked(host):
+    breaker = host_breakers.get(host)
+    if breaker is None or breaker["state"] == "closed":
+        return False
+    if breaker["state"] == "half-open":
+        return True
+    return time.monotonic() - breaker["opened_at"] < BREAKER_RESET_TIMEOUT
 
+
+def breaker_success(host):
+    breaker = get_breaker(host)
+    if breaker["state"] != "closed":
+        logging.warning(f"Магазин {host} снова доступен")
+    breaker["state"] = "closed"
+    breaker["failures"] = 0
+
+
+# Пробный запрос завершился без ответа (например, задача отменена): breaker не должен остаться
+# в half-open навсегда - снова открываем его и ждем следующей попытки
+def breaker_probe_done(host):
+    breaker = get_breaker(host)
+    if breaker["state"] == "half-open":
+        breaker["state"] = "open"
+        breaker["opened_at"] = time.monotonic()
+
+
+def breaker_failure(host):
+    breaker = get_breaker(host)
+    breaker["failures"] += 1
+    if breaker["state"] == "half-open" or (
+        breaker["state"] == "closed" and breaker["failures"] >= BREAKER_FAILURE_THRESHOLD
+    ):
+        breaker["state"] = "open"
+        breaker["opened_at"] = time.monotonic()
+        logging.warning(
+            f"Магазин {host} недоступен после {breaker['failures']} ошибок, "
+            f"следующая попытка через {BREAKER_RESET_TIMEOUT} сек"
+        )
+
+
+# Возвращает состояние breaker и частоту запросов (в секунду) для каждого хоста
+def get_host_stats():
+    now = time.monotonic()
+    stats = {}
+    for host in set(host_breakers) | set(host_requests):
+        breaker = get_breaker(host)
+        requests_times = host_requests.get(host, ())
+        recent = sum(1 for item in requests_times if item >= now - HOST_STATS_WINDOW)
+        stats[host] = {
+            "state": breaker["state"],
+            "failures": breaker["failures"],
+            "requests_per_sec": round(recent / HOST_STATS_WINDOW, 2),
+        }
+    return stats
+
+
+# -----------------------------------------------------------------------------------------------------------------------Потоковый разбор страницы
+# Ищет поля (цена, наличие и т.д.) по регулярным выражениям в кусках страницы по мере загрузки
+class StreamExtractor:
+    # Сколько символов с конца уже просмотренного текста искать повторно (поле может попасть на границу кусков)
+    overlap = 4096
+
+    def __init__(self, patterns):
+        # patterns - словарь: поле -> регулярное выражение (значение берется из первой группы, если она есть)
+        self.patterns = {field: re.compile(pattern) for field, pattern in patterns.items()}
+        self.found = {}
+        # Храним только конец прочитанного текста: страница целиком в памяти не собирается
+        self.tail = ""
+
+    # Добавляем кусок текста, возвращаем True, когда найдены все поля.
+    # Совпадение, которое упирается в конец прочитанного текста, может продолжиться в следующем куске
+    # (цена "12" из "12345") - такое принимаем только в конце страницы (final=True)
+    def feed(self, chunk, final=False):
+        text = self.tail + chunk
+        keep_from = max(len(text) - self.overlap, 0)
+        for field, pattern in self.patterns.items():
+            if field in self.found:
+                continue
+            match = pattern.search(text)
+            if match is None:
+                continue
+            if match.end() == len(text) and not final:
+                keep_from = min(keep_from, match.start())  # Ищем его снова вместе со следующим куском
+                continue
+            self.found[field] = match.group(1) if pattern.groups else match.group(0)
+        self.tail = text[keep_from:]
+        return self.done()
+
+    def done(self):
+        return len(self.found) == len(self.patterns)
+
+
+# Читаем ответ кусками, пока extractor не найдет все поля или не прочитано max_bytes байт.
+# Возвращаем найденные поля
+async def read_until_extracted(response, extractor, max_bytes):
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    read_bytes = 0
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        read_bytes += len(chunk)
+        if extractor.feed(decoder.decode(chunk)) or (max_bytes and read_bytes >= max_bytes):
+            response.close()  # Остаток страницы не читаем, соединение закрываем
+            break
+    else:
+        # Страница прочитана целиком: дописываем остаток декодера и принимаем совпадения у конца текста
+        extractor.feed(decoder.decode(b"", final=True), final=True)
+    return extractor.found
+
+
+# -----------------------------------------------------------------------------------------------------------------------
+# extractor - если задан (StreamExtractor), страница читается потоково до нахождения всех полей,
+# и вместо текста страницы возвращается словарь найденных полей (extractor.found)
+async def get_item_from_url(url, number_header, extractor=None, market=None):
+
+    if number_header == 1:
         default_headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,/;q=0.8,application/signed-exchange;v=b3;q=0.7",
@@ -24,47 +286,470 @@ async def get_item_from_url(url, number_header):
     else:
         default_headers = {}
 
+    host = urlparse(url).netloc
+    probe = False  # Этот запрос - пробный для открытого breaker
     try:
-        response = requests.get(
-            url, headers=default_headers)
-          # Используйте requests.get для простоты
-        response.raise_for_status()  # Проверка для HTTP ошибок (например, 404, 500 и т.д.)
-        x = response.text  # Получаем JSON ответ от сервера
+        context = fetch_context.get()
+        validators = None
+        if context is not None:
+            validators = await get_validators(url)
+            if validators:
+                default_headers = dict(default_headers)
+                if validators[0]:
+                    default_headers["If-None-Match"] = validators[0]
+                if validators[1]:
+                    default_headers["If-Modified-Since"] = validators[1]
+            market_stats = http_cache_stats.setdefault(
+                context["market"], {"hits": 0, "misses": 0, "bytes_saved": 0}
+            )
+
+        if not breaker_allow(host):
+            logging.info(f"Магазин {host} временно недоступен, пропускаем {url}")
+            return None
+        probe = get_breaker(host)["state"] == "half-open"
+
+        http_session = await get_session()
+        for attempt in range(HTTP_RETRIES + 1):
+            await acquire_host_token(host)  # Не чаще HOST_RATE_LIMIT запросов к одному хосту
+            retry_delay = None
+            try:
+                async with http_semaphore:  # Не больше HTTP_MAX_IN_FLIGHT запросов одновременно
+                    async with http_session.get(url, headers=default_headers) as response:
+                        record_host_request(host)
+                        if response.status in HTTP_RETRY_STATUSES and attempt < HTTP_RETRIES:
+                            retry_delay = backoff_delay(
+                                attempt, response.headers.get("Retry-After")
+                            )
+                        elif context is not None and response.status == 304:
+                            # Страница не изменилась с прошлой проверки
+                            breaker_success(host)
+                            context["not_modified"] = True
+                            market_stats["hits"] += 1
+                            market_stats["bytes_saved"] += validators[2] or 0
+                            return None
+                        else:
+                            response.raise_for_status()  # Проверка для HTTP ошибок (например, 404, 500 и т.д.)
+                            if extractor is None:
+                                x = await response.text(errors="replace")  # Получаем текст ответа от сервера
+                                body_size = len(x.encode("utf-8"))
+                            else:
+                                # Страница прочитана не целиком - размер берем из заголовка
+                                body_size = int(response.headers.get("Content-Length") or 0) or None
+                                if market is None and context is not None:
+                                    market = context["market"]
+                                max_bytes = MARKET_STREAM_MAX_BYTES.get(
+                                    market, MARKET_STREAM_MAX_BYTES_DEFAULT
+                                )
+                                x = await read_until_extracted(response, extractor, max_bytes)
+                            break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= HTTP_RETRIES:
+                    raise
+                retry_delay = backoff_delay(attempt)
+
+            logging.warning(
+                f"Повтор запроса {url} через {retry_delay:.1f} сек (попытка {attempt + 1} из {HTTP_RETRIES})"
+            )
+            await asyncio.sleep(retry_delay)
+
+        breaker_success(host)
+        if context is not None:
+            market_stats["misses"] += 1
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                new_validators = (etag, last_modified, body_size)
+                if validators is None or new_validators[:2] != validators[:2]:
+                    context["validators"][url] = new_validators
         return x
-    except requests.exceptions.HTTPError as http_err:
-        logging.exception(
-            f"HTTP error occurred: {http_err}"
-        )  # Вывод ошибки для отладки
+    except aiohttp.ClientResponseError as http_err:
+        if http_err.status in HTTP_PAGE_ERROR_STATUSES:
+            breaker_success(host)  # Магазин отвечает, ошибка относится к странице (например, 404)
+        else:
+            breaker_failure(host)  # Магазин нас блокирует (403) или не справляется (5xx)
+        logging.error(f"HTTP error occurred: {http_err}")  # Вывод ошибки для отладки
+    except asyncio.TimeoutError:
+        breaker_failure(host)
+        logging.error(f"Timeout while fetching {url}")
+    except aiohttp.ClientConnectionError as err:
+        breaker_failure(host)
+        logging.error(f"Connection error while fetching {url}: {err}")
     except Exception as err:
+        breaker_failure(host)
         logging.exception(f"An error occurred: {err}")  # Общая обработка исключений
+    finally:
+        if probe:
+            breaker_probe_done(host)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Разбор HTML в пуле процессов
+# Инициализация глобальной переменной для пула процессов
+parse_executor = None
+
+# Ограничивает количество страниц, ожидающих разбора (backpressure)
+parse_semaphore = asyncio.Semaphore(PARSE_MAX_PENDING)
+
+
+# Пустая задача для прогрева процессов пула
+def parse_worker_ready():
+    return os.getpid()
+
+
+# Создает пул процессов и запускает все процессы заранее.
+# Процессы не копируем fork-ом из бота: иначе им достаются открытые соединения с базой и состояние
+# event loop. forkserver (или spawn, где его нет, например в Windows) запускает чистые процессы
+async def start_parse_executor():
+    global parse_executor
+    if parse_executor is None:
+        workers = PARSE_WORKERS or os.cpu_count() or 1
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        parse_executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(parse_executor, parse_worker_ready)
+                for _ in range(workers)
+            )
+        )
+    return parse_executor
+
+
+# Закрывает пул процессов
+async def close_parse_executor():
+    global parse_executor
+    if parse_executor is not None:
+        parse_executor.shutdown(wait=False, cancel_futures=True)
+        parse_executor = None
+
+
+# Разбираем страницу в отдельном процессе, чтобы не блокировать бота
+# parser - функция уровня модуля: parser(html) -> компактный результат (кортеж / список)
+async def parse_in_process(parser, html):
+    if html is None:
+        return None
+    executor = await start_parse_executor()
+    async with parse_semaphore:  # Не больше PARSE_MAX_PENDING страниц в очереди на разбор
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, parser, html)
+        except Exception as err:
+            logging.exception(f"Ошибка при разборе страницы: {err}")
+            return None
+
+
+# Загружаем страницу и разбираем ее в пуле процессов
+async def get_parsed_item_from_url(url, number_header, parser):
+    html = await get_item_from_url(url, number_header)
+    return await parse_in_process(parser, html)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Пакетная загрузка цен через JSON API
+# Статусы наличия, как их записывает разбор страниц товаров
+STATUS_IN_STOCK = "В наличии"
+STATUS_OUT_OF_STOCK = "Нет в наличии"
+
+
+# Достаем из ссылки ключ товара в API магазина
+def get_batch_api_key(market, url):
+    path = urlparse(url).path
+    if market == "wb":
+        match = re.search(r"/catalog/(\d+)", path)
+        return match.group(1) if match else None
+    if market == "onliner":
+        parts = [part for part in path.split("/") if part]
+        return parts[-1] if parts else None
+    return None
+
+
+# Разбор ответа API Wildberries: ключ -> (название, цена в копейках, статус)
+def parse_wb_batch(text):
+    data = json.loads(text)
+    products = (data.get("data") or {}).get("products") or data.get("products") or []
+    result = {}
+    for item in products:
+        prices = [
+            (size.get("price") or {}).get("product")
+            for size in item.get("sizes") or []
+        ]
+        prices = [price for price in prices if price]
+        if prices and item.get("totalQuantity"):
+            result[str(item["id"])] = (item.get("name"), min(prices), STATUS_IN_STOCK)
+        else:
+            result[str(item["id"])] = (item.get("name"), None, STATUS_OUT_OF_STOCK)
+    return result
+
+
+# Разбор ответа API onliner: ключ -> (название, цена в копейках, статус)
+def parse_onliner_batch(text):
+    data = json.loads(text)
+    result = {}
+    for item in data.get("products") or []:
+        price_min = ((item.get("prices") or {}).get("price_min") or {}).get("amount")
+        if price_min:
+            price = int(round(float(price_min) * 100))
+            result[item["key"]] = (item.get("full_name"), price, STATUS_IN_STOCK)
+        else:
+            result[item["key"]] = (item.get("full_name"), None, STATUS_OUT_OF_STOCK)
+    return result
+
+
+# Формируем адрес пакетного запроса для списка ключей
+def get_batch_api_url(market, keys):
+    if market == "wb":
+        return WB_BATCH_API_URL.format(ids=";".join(keys))
+    return ONLINER_BATCH_API_URL.format(keys=urlencode([("key[]", key) for key in keys]))
+
+
+# Загружаем цены товаров одного магазина пакетами
+# Возвращаем словарь product_id -> результат в формате is_link_belongs_to_site
+async def fetch_batch_prices(market, products):
+    parser = parse_wb_batch if market == "wb" else parse_onliner_batch
+    keys = {}  # ключ в API -> список товаров
+    for product in products:
+        key = get_batch_api_key(market, product[1])
+        if key:
+            keys.setdefault(key, []).append(product)
+
+    results = {}
+    key_list = list(keys)
+    size = BATCH_API_SIZE[market]
+    for start in range(0, len(key_list), size):
+        chunk = key_list[start:start + size]
+        text = await get_item_from_url(get_batch_api_url(market, chunk), 0)
+        if text is None:
+            continue
+        # JSON разбираем прямо здесь: json.loads быстрее, чем передача ответа в пул процессов и обратно
+        try:
+            parsed = parser(text)
+        except Exception as err:
+            logging.exception(f"Ошибка при разборе ответа API {market}: {err}")
+            continue
+        for key in chunk:
+            if key not in parsed:
+                continue
+            title, price, status = parsed[key]
+            for product in keys[key]:
+                results[product[0]] = [title, product[1], None, price, status, market]
+    return results
+
+
+# -----------------------------------------------------------------------------------------------------------------------Проверяем цену одного товара
+# Не удалось получить данные о товаре: страница не загрузилась или не разобрана
+class ProductCheckError(Exception):
+    pass
+
+
+# result2 - последняя запись о цене товара из базы
+# result - уже полученные данные о товаре (например, из пакетного API), иначе загружаем страницу
+# validators - словарь url -> новые ETag / Last-Modified (None - удалить сохраненные), его записывает check_price
+# Если цена или наличие изменились, возвращаем (product_id, статус, время, цена) для записи в базу, иначе None
+async def check_price_one_product(product, result2, result=None, validators=None):
+    if result is None:
+        context = {"market": product[2], "not_modified": False, "validators": {}}
+        token = fetch_context.set(context)
+        try:
+            # Предполагаем, что is_link_belongs_to_site - асинхронная
+            result = await is_link_belongs_to_site(product[1])
+        except Exception:
+            result = None
+            raise
+        finally:
+            fetch_context.reset(token)
+            if validators is not None and not context["not_modified"]:
+                if result and len(result) > 4:
+                    validators.update(context["validators"])
+                else:
+                    # Страницу не разобрали - следующая проверка должна загрузить ее целиком, а не получить 304
+                    for url in {product[1], *context["validators"]}:
+                        validators[url] = None
+
+        if context["not_modified"]:
+            return None  # Страница не изменилась (304) - не сравниваем и ничего не пишем
+
+    if not result or len(result) <= 4:
+        raise ProductCheckError(f"Нет данных о товаре {product[0]}: {product[1]}")
+
+    # print(result[3], result2[3], result[4], result2[2])
+
+    if result2:
+        # Проверяем длину списков / корректность индексов, чтобы избежать ошибок
+        if len(result2) > 3:
+            if result[3] != result2[3] or result[4] != result2[2]:
+                current_time = int(time.time())
+                return (product[0], result[4], current_time, result[3])
+        else:
+            logging.warning(
+                f"Получены некорректные данные по продукту {product[0]}"
+            )
+    return None
+
+
+# -----------------------------------------------------------------------------------------------------------------------Записываем ETag / Last-Modified после цикла
+# Новые валидаторы сохраняем, только если изменения цикла записаны: иначе 304 спрятал бы незаписанную цену.
+# Валидаторы страниц, которые не удалось разобрать, удаляем
+async def update_validators(validators, written):
+    new_validators = []
+    dropped = []
+    for url, item in validators.items():
+        if item is None:
+            http_validators[url] = None
+            dropped.append(url)
+        elif written:
+            http_validators[url] = item
+            new_validators.append((url, *item))
+    await save_http_validators(new_validators)
+    await delete_http_validators(dropped)
 
 
 # -----------------------------------------------------------------------------------------------------------------------Проверяем цены и записываем в базу
-async def check_price(list_from_db):
+# Все изменения цикла записываются в базу одним пакетом в конце
+# concurrent=True - товары проверяются параллельно, но не больше MARKET_CONCURRENCY запросов на один магазин
+# slot - за сколько секунд должен пройти цикл, товары проверенные позже считаются опоздавшими
+async def check_price(list_from_db, concurrent=True, slot=None):
+    start_time = time.monotonic()
+    stats = {}  # market -> {"count": ..., "errors": ..., "missed": ..., "skipped": ..., "time": ...}
+    semaphores = {}
+    changes = []  # Изменения цен и наличия для записи в базу
+    changed = []  # ID товаров, у которых записана новая цена или наличие
+    last_prices = {}  # product_id -> последняя запись о цене
+    latencies = []  # Время успешной проверки каждого товара (в секундах)
+    validators = {}  # url -> новые ETag / Last-Modified (None - удалить)
+
+    async def check_one(product, result=None):
+        market = product[2]
+        market_stats = stats.setdefault(
+            market, {"count": 0, "errors": 0, "missed": 0, "skipped": 0, "time": 0}
+        )
+        if is_host_blocked(urlparse(product[1]).netloc):
+            market_stats["skipped"] += 1  # Магазин недоступен, товар не проверяем
+            return
+
+        if market not in semaphores:
+            limit = MARKET_CONCURRENCY.get(market, MARKET_CONCURRENCY_DEFAULT)
+            semaphores[market] = asyncio.Semaphore(limit)
+
+        async with semaphores[market]:
+            product_start = time.monotonic()
+            failed = True
+            try:
+                change = await check_price_one_product(
+                    product, last_prices.get(product[0]), result, validators
+                )
+                if change:
+                    changes.append(change)
+                failed = False
+            except ProductCheckError as err:
+                logging.warning(str(err))
+            except Exception as err:
+                logging.error(
+                    f"An error occurred - product {product[0]}: {err}", exc_info=True
+                )
+            if not failed:
+                latencies.append(time.monotonic() - product_start)
+
+        # Товары с ошибкой не входят ни в количество проверенных, ни во время проверки
+        finished = time.monotonic() - start_time
+        if failed:
+            market_stats["errors"] += 1
+        else:
+            market_stats["count"] += 1
+        market_stats["time"] = finished
+        if slot and finished > slot:
+            market_stats["missed"] += 1
 
     try:
+        # Последние цены всех товаров цикла получаем одним запросом
+        last_prices = await check_price_products(
+            [product[0] for product in list_from_db]
+        )
+
+        # Товары onliner и wb проверяем пакетами через API, остальные - по страницам
+        batch_products = {}
+        page_products = []
         for product in list_from_db:
-            # Предполагаем, что is_link_belongs_to_site - асинхронная
-            result = await is_link_belongs_to_site(product[1])
+            if product[2] in BATCH_API_SIZE:
+                batch_products.setdefault(product[2], []).append(product)
+            else:
+                page_products.append(product)
 
-            result2 = await check_price_product(product[0])
-            # print(result[3], result2[3], result[4], result2[2])
-
-            if result and result2:
-                # Проверяем длину списков / корректность индексов, чтобы избежать ошибок
-                if len(result) > 4 and len(result2) > 3:
-                    if result[3] != result2[3] or result[4] != result2[2]:
-                        current_time = int(time.time())
-                        await add_new_price_product(
-                            product[0], result[4], current_time, result[3]
-                        )
-                else:
-                    logging.warning(
-                        f"Получены некорректные данные по продукту {product[0]}"
-                    )
+        async def check_batch(market, products):
+            try:
+                results = await fetch_batch_prices(market, products)
+            except Exception as err:
+                logging.error(f"Ошибка пакетного запроса {market}: {err}", exc_info=True)
+                results = {}
+            # Товары, которых нет в ответе API, проверяем по странице
+            if concurrent:
+                await asyncio.gather(
+                    *(check_one(product, results.get(product[0])) for product in products)
+                )
+            else:
+                for product in products:
+                    await check_one(product, results.get(product[0]))
+
+        if concurrent:
+            await asyncio.gather(
+                *(check_batch(market, products) for market, products in batch_products.items()),
+                *(check_one(product) for product in page_products),
+            )
+        else:
+            for market, products in batch_products.items():
+                await check_batch(market, products)
+            for product in page_products:
+                await check_one(product)
     except Exception as err:
         logging.error(f"An error occurred: {err}", exc_info=True)
 
+    written = True
+    if changes:
+        changed = await add_new_prices_bulk(changes)
+        if changed is None:
+            written = False
+            changed = []
+    await update_validators(validators, written)
+
+    wall_time = time.monotonic() - start_time
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100)
+        latency = {
+            "p50": round(percentiles[49], 3),
+            "p95": round(percentiles[94], 3),
+            "p99": round(percentiles[98], 3),
+        }
+    else:
+        latency = {"p50": None, "p95": None, "p99": None}
+    report = {
+        "wall_time": round(wall_time, 3),
+        "products": sum(item["count"] for item in stats.values()),
+        "errors": sum(item["errors"] for item in stats.values()),
+        "missed": sum(item["missed"] for item in stats.values()),
+        "skipped": sum(item["skipped"] for item in stats.values()),
+        "changed": changed,
+        "latency": latency,
+        "markets": {
+            market: {
+                "count": item["count"],
+                "errors": item["errors"],
+                "missed": item["missed"],
+                "skipped": item["skipped"],
+                # Товаров в секунду по магазину
+                "throughput": round(item["count"] / item["time"], 2) if item["time"] else 0,
+            }
+            for market, item in stats.items()
+        },
+        "http_cache": get_http_cache_stats(),
+        "hosts": get_host_stats(),
+    }
+    logging.info(f"Цикл проверки цен: {report}")
+    if report["missed"]:
+        logging.warning(
+            f"Цикл проверки цен не уложился в {slot} сек: опоздали {report['missed']} товаров, {report}"
+        )
+    return report
+
 
 # _______________________________________________________________________________________________________________________ Функция для преобразования временной метки в строковую дату
 async def convert_date_to_str(date_sec, hours):
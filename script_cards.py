@@ -0,0 +1,127 @@
+# Подписи карточек товаров: карточка по кнопке и сообщение рассылки.
+# Подпись зависит только от товара и его цен, поэтому строится один раз на каждую
+# новую запись в истории цен (last_history_id) и используется для всех пользователей.
+from config import CARD_CACHE_SIZE, CARD_CACHE_TTL
+from database import ProductCache
+from script import convert_date_to_str
+
+
+# (вид подписи, product_id) -> подпись, версия - last_history_id товара
+card_cache = ProductCache(CARD_CACHE_SIZE, CARD_CACHE_TTL)
+
+
+def price_str(price):
+    return round(float(price) / 100, 2)
+
+
+# -----------------------------------------------------------------------------------------------------------------------Карточка товара
+async def render_product_card(card):
+    if card["distinct_prices"] >= 2:
+        min_max_str = f"<b>Мин. / Макс. цена:</b> {price_str(card['min_price'])} / {price_str(card['max_price'])} BYN\n"
+        if card["last_price"] == card["min_price"]:
+            super_price = "✅ Самая низкая цена\n"
+        else:
+            super_price = ""
+
+    else:
+        if card["last_price"]:
+            min_max_str = f"<b>Мин. / Макс. цена:</b> {price_str(card['last_price'])} BYN\n"
+        elif card["min_price"]:
+            min_max_str = f"<b>Мин. / Макс. цена:</b> {price_str(card['min_price'])} BYN\n"
+        else:
+            min_max_str = ""
+        super_price = ""
+
+    timestr = await convert_date_to_str(card["last_time"], 3)
+
+    if card["last_price"]:
+        text_price = f"<b>Цена:</b> {price_str(card['last_price'])} BYN\n"
+    else:
+        text_price = ""
+
+    return (
+        f"<b>Магазин:</b> {card['market']}\n"
+        f'<b>Товар:</b> <a href="{card["product_url"]}">{card["product_title"]}</a>\n'
+        f"<b>Статус:</b> {card['last_status']}\n\n"
+        f"{text_price}"
+        f"{super_price}"
+        f"{min_max_str}"
+        f"Последнее изменение: {timestr}"
+    )
+
+
+# -----------------------------------------------------------------------------------------------------------------------Сообщение рассылки
+async def render_price_notification(card):
+    if card["distinct_prices"] >= 2:
+        min_max_str = f"<b>Мин. / Макс. цена:</b> {price_str(card['min_price'])} / {price_str(card['max_price'])} BYN\n"
+        if card["last_price"] == card["min_price"]:
+            super_price = "🟢🟢🟢 Самая низкая цена\n"
+        else:
+            super_price = ""
+
+    else:
+        if card["last_price"]:
+            min_max_str = f"<b>Мин. / Макс. цена:</b> {price_str(card['last_price'])} BYN\n"
+        else:
+            min_max_str = ""
+        super_price = ""
+
+    last_price = card["last_price"]
+    previous_price = card["previous_price"]
+    if last_price and previous_price:
+        delta = round(float(last_price) / 100 - float(previous_price) / 100, 2)
+    else:
+        delta = 0
+
+    if delta < 0:
+        deltamodul = 0 - delta
+        procent = deltamodul / float(previous_price) * 10000
+        textdelta = f"🟢 Цена снизилась на {deltamodul} BYN  ( -{round(procent, 1)} %)"
+    elif delta > 0:
+        deltamodul = delta
+        procent = deltamodul / float(previous_price) * 10000
+        textdelta = f"🔴 Цена повысилась на {deltamodul} BYN  ( +{round(procent, 1)} %)"
+    else:
+        textdelta = "Изменилось наличие"
+
+    if last_price:
+        cenatxt = f"<b>Цена:</b> {price_str(last_price)} BYN\n"
+    else:
+        cenatxt = ""
+
+    timestr = await convert_date_to_str(card["last_time"], 3)
+
+    return (
+        f"<b>Магазин:</b> {card['market']}\n"
+        f'<b>Товар:</b> <a href="{card["product_url"]}">{card["product_title"]}</a>\n'
+        f"<b>Статус:</b> {card['last_status']}\n\n"
+        f"{cenatxt}"
+        f"{super_price}"
+        f"{min_max_str}"
+        f"{textdelta}\n"
+        f"Обновлено: {timestr}"
+    )
+
+
+CARD_RENDERERS = {
+    "card": render_product_card,
+    "notification": render_price_notification,
+}
+
+
+# -----------------------------------------------------------------------------------------------------------------------Подпись из кэша
+# card - результат get_product_card, kind - "card" или "notification".
+# Новая цена в истории меняет last_history_id, и подпись строится заново
+async def get_card_caption(card, kind):
+    key = (kind, card["id"])
+    found, caption = card_cache.get(key, card["last_history_id"])
+    if found:
+        return caption
+
+    caption = await CARD_RENDERERS[kind](card)
+    card_cache.set(key, caption, card["last_history_id"])
+    return caption
+
+
+def get_card_cache_stats():
+    return card_cache.stats()
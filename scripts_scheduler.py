@@ -1,135 +1,194 @@
+import asyncio
+import heapq
 import logging
+import random
+import time
 
 from aiogram import Bot
 
-from database import (change_status_product, check_last_two_price_times,
-                      check_price_product, get_list_product,
+from config import (MARKET_POLL_INTERVAL, MARKET_POLL_INTERVAL_DEFAULT,
+                    NOTIFY_DEBOUNCE, NOTIFY_HEALTHCHECK_INTERVAL,
+                    POLL_INTERVAL_GROWTH, POLL_INTERVAL_SHRINK, SCHEDULER_TICK,
+                    THRESHOLD_EDGE_PERCENT,)
+
+from database import (PRICE_CHANGED_CHANNEL, change_status_product,
+                      connect_listener, db_session, get_list_product,
                       get_list_product_for_rassilka, get_list_users_for_rassilka,
-                      min_max_price_product,)
-from database_redis import update_redis_user_list_products_keyboard
+                      get_product_card, get_threshold_edge_products,)
+from database_redis import invalidate_products_keyboards
 from keyboards import user_info_product
-from script import check_price, convert_date_to_str
+from script import check_price
+from script_cards import get_card_caption
 
 
-async def price_update_interval():
-    product_list = await get_list_product()
+# -----------------------------------------------------------------------------------------------------------------------Адаптивная проверка цен
+# Очередь товаров на проверку: (время следующей проверки, product_id)
+price_queue = []
+# product_id -> {"product": (id, url, market), "interval": ..., "next_due": ...}
+price_schedule = {}
 
-    product_list_interval =[]
+
+# Добавляем в расписание новые товары и убираем удаленные
+async def sync_price_schedule(now):
+    product_list = await get_list_product()
+    if product_list is None:
+        # Список товаров не прочитан: расписание (и накопленные интервалы) не трогаем
+        return
+    product_ids = set()
     for product in product_list:
-        if product[2] in ['onliner', 'wb']:
-            product_list_interval.append(product)
+        product_ids.add(product[0])
+        if product[0] not in price_schedule:
+            min_interval = MARKET_POLL_INTERVAL.get(
+                product[2], MARKET_POLL_INTERVAL_DEFAULT
+            )[0]
+            # Первую проверку разносим по минимальному интервалу магазина,
+            # чтобы после запуска все товары не проверялись одним пакетом
+            next_due = now + random.uniform(0, min_interval)
+            price_schedule[product[0]] = {
+                "product": product,
+                "interval": min_interval,
+                "next_due": next_due,
+            }
+            heapq.heappush(price_queue, (next_due, product[0]))
+
+    for product_id in list(price_schedule):
+        if product_id not in product_ids:
+            del price_schedule[product_id]  # Запись в очереди пропустится при извлечении
+
+
+# Пересчитываем интервал товара после проверки
+def next_poll_interval(item, changed, on_threshold_edge):
+    min_interval, max_interval = MARKET_POLL_INTERVAL.get(
+        item["product"][2], MARKET_POLL_INTERVAL_DEFAULT
+    )
+    if on_threshold_edge:
+        return min_interval
+    if changed:
+        interval = item["interval"] * POLL_INTERVAL_SHRINK
+    else:
+        interval = item["interval"] * POLL_INTERVAL_GROWTH
+    return max(min_interval, min(max_interval, interval))
+
+
+async def price_update_adaptive():
+    try:
+        now = time.time()
+        await sync_price_schedule(now)
+
+        # Извлекаем из очереди все товары, которые пора проверить
+        due_products = []
+        while price_queue and price_queue[0][0] <= now:
+            next_due, product_id = heapq.heappop(price_queue)
+            item = price_schedule.get(product_id)
+            if item is None or item["next_due"] != next_due:
+                continue  # Товар удален или уже перепланирован
+            due_products.append(item["product"])
+
+        if not due_products:
+            return
+
+        report = await check_price(due_products, slot=SCHEDULER_TICK)
+        changed = set(report["changed"])
+        threshold_edge = await get_threshold_edge_products(
+            [product[0] for product in due_products], THRESHOLD_EDGE_PERCENT
+        )
+
+        finished = time.time()
+        for product in due_products:
+            item = price_schedule.get(product[0])
+            if item is None:
+                continue
+            item["interval"] = next_poll_interval(
+                item, product[0] in changed, product[0] in threshold_edge
+            )
+            item["next_due"] = finished + item["interval"]
+            heapq.heappush(price_queue, (item["next_due"], product[0]))
+
+        # Перестраиваем клавиатуры только у пользователей изменившихся товаров
+        await invalidate_products_keyboards(changed)
 
-    await check_price(product_list_interval)
-    await update_redis_user_list_products_keyboard()
+    except Exception as e:
+        logging.exception(f"Ошибка при адаптивной проверке цен: {e}")
 
 
 
-async def price_update_cron():
-    product_list = await get_list_product()
+# -----------------------------------------------------------------------------------------------------------------------Рассылка по уведомлениям из базы
+# Рассылка запускается и по уведомлению, и по расписанию - не даем ей идти параллельно
+rassilka_lock = asyncio.Lock()
 
-    product_list_interval =[]
-    for product in product_list:
-        if product[2] in ['remzona', 'shate-mag', '21vek']:
-            product_list_interval.append(product)
 
-    await check_price(product_list_interval)
-    await update_redis_user_list_products_keyboard()
+# Слушаем уведомления об изменении цен и сразу запускаем рассылку.
+# При обрыве соединения переподключаемся и делаем рассылку по всем отмеченным товарам.
+async def listen_price_changes(bot: Bot):
+    while True:
+        conn = None
+        try:
+            changed_event = asyncio.Event()
+            conn = await connect_listener(
+                PRICE_CHANGED_CHANNEL, lambda *args: changed_event.set()
+            )
+            await rassilka_for_users(bot)  # Изменения, пришедшие пока слушатель не работал
 
+            while not conn.is_closed():
+                try:
+                    await asyncio.wait_for(
+                        changed_event.wait(), timeout=NOTIFY_HEALTHCHECK_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    await conn.fetchval("SELECT 1")  # Проверяем, что соединение живо
+                    continue
+
+                await asyncio.sleep(NOTIFY_DEBOUNCE)  # Собираем изменения всего цикла проверки
+                changed_event.clear()
+                await rassilka_for_users(bot)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(f"Ошибка слушателя изменений цен: {e}")
+            await asyncio.sleep(5)
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
 
 
 async def rassilka_for_users(bot: Bot):
+    async with rassilka_lock:
+        await send_rassilka(bot)
+
+
+async def send_rassilka(bot: Bot):
     try:
         product_list = await get_list_product_for_rassilka(1)
-        # print(product_list)
         if product_list:
             for item in product_list:
                 product_id = int(item[0])
-                # print(item)
-                result = await check_price_product(product_id)
-                # print(result)
-                timeadd = result[4]
-                timestr = await convert_date_to_str(timeadd, 3)
-                result2 = await check_last_two_price_times(product_id)
-                min_max = await min_max_price_product(product_id)
-                if min_max:
-                    min_max_str = f"<b>Мин. / Макс. цена:</b> {round(float(min_max[0])/100,2)} / {round(float(min_max[1])/100,2)} BYN\n"
-                    if result[3] == min_max[0]:
-                        super_price = "🟢🟢🟢 Самая низкая цена\n"
-                    else:
-                        super_price = ""
-
-                else:
-                    if result[3]:
-                        min_max_str = f"<b>Мин. / Макс. цена:</b> {round(float(result[3]/100), 2)} BYN\n"
-                    else:
-                        min_max_str = ""
-                    super_price = ""
-
-                # (result2)
-                if result2[0] and result2[1]:
-                    delta = round(float(result2[0]) / 100 - float(result2[1]) / 100, 2)
-                else:
-                    delta = 0
-
-                if delta < 0:
-                    deltamodul = 0 - delta
-                    procent = deltamodul / float(result2[1]) * 10000
-                    textdelta = f"🟢 Цена снизилась на {deltamodul} BYN  ( -{round(procent, 1)} %)"
-                elif delta > 0:
-                    deltamodul = delta
-                    procent = deltamodul / float(result2[1]) * 10000
-                    textdelta = f"🔴 Цена повысилась на {deltamodul} BYN  ( +{round(procent, 1)} %)"
-                else:
-                    textdelta = "Изменилось наличие"
-
-                list_of_users = await get_list_users_for_rassilka(product_id)
+                # Запросы к базе по товару - через одно соединение, отправку сообщений в сессию не включаем
+                async with db_session():
+                    card = await get_product_card(product_id)
+                    list_of_users = await get_list_users_for_rassilka(product_id)
+                if card is None:
+                    continue
+                # Подпись одна для всех пользователей товара, для каждого - только клавиатура
+                text = await get_card_caption(card, "notification")
+                last_price = card["last_price"]
 
                 for user in list_of_users:
-                    if result2[0] and result2[0] is not None:
-                        cenatxt = f"<b>Цена:</b> {round(float(result2[0])/100,2)} BYN\n"
-                    else:
-                        cenatxt = ""
-
-                    text = (
-                        f"<b>Магазин:</b> {item[5]}\n"
-                        f'<b>Товар:</b> <a href="{item[1]}">{item[2]}</a>\n'
-                        f"<b>Статус:</b> {result[2]}\n\n"
-                        f"{cenatxt}"
-                        f"{super_price}"
-                        f"{min_max_str}"
-                        f"{textdelta}\n"
-                        f"Обновлено: {timestr}"
-                    )
-
-                    threshold = user[3]
+                    threshold = user["threshold"]
+                    # С порогом сообщаем, только если цена опустилась ниже него
+                    if threshold and (last_price is None or last_price >= threshold):
+                        continue
 
                     try:
-
-                        if threshold and result2[0] < threshold:
-
-                            await bot.send_photo(
-                                chat_id=user[1],
-                                photo=item[3],
-                                caption=text,
-                                reply_markup=await user_info_product(
-                                    user[1], product_id
-                                ),
-                                parse_mode="HTML",
-                            )
-                        elif threshold and result2[0] >= threshold:
-                            continue
-
-                        else:
-
-                            await bot.send_photo(
-                                chat_id=user[1],
-                                photo=item[3],
-                                caption=text,
-                                reply_markup=await user_info_product(
-                                    user[1], product_id
-                                ),
-                                parse_mode="HTML",
-                            )
+                        await bot.send_photo(
+                            chat_id=user[1],
+                            photo=card["product_image_url"],
+                            caption=text,
+                            reply_markup=await user_info_product(
+                                user[1], product_id, user["in_pool"]
+                            ),
+                            parse_mode="HTML",
+                        )
 
                     except Exception as e:
                         logging.exception(